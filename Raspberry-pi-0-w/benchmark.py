@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the camera server pipelines
+Usage:
+  python3 benchmark.py stream footage.mp4   (MJPEG vs H.264 bytes/s and CPU)
+  python3 benchmark.py qr-capture           (QR frame paths, needs the camera)
+  python3 benchmark.py qr-backends frames/  (QR decoder backends on recorded frames)
+  python3 benchmark.py replay frames/       (stream fan-out and QR paths, JSON report)
+  python3 benchmark.py ramp                 (motor ramp CPU and tick jitter, simulated GPIO)
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+# Stream settings (match main-4.py)
+CAMERA_MAIN_SIZE = (640, 480)
+CAMERA_FPS = 30
+H264_BITRATE = 1500000
+H264_KEYFRAME_INTERVAL = 30
+
+def load_server():
+    """Import main-4.py (its file name is not a valid module name)"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main-4.py')
+    spec = importlib.util.spec_from_file_location('camera_server', path)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def children_cpu_seconds():
+    """User + system CPU time used by finished child processes so far"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def ffmpeg_has_encoder(name):
+    """Check whether the local ffmpeg build offers an encoder"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return any(line.split()[1:2] == [name] for line in result.stdout.splitlines())
+
+def run_ffmpeg(footage, seconds, codec_args):
+    """Transcode footage at the stream size; return (frames, bytes, cpu_seconds)"""
+    width, height = CAMERA_MAIN_SIZE
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats',
+               '-i', footage, '-t', str(seconds),
+               '-vf', f'scale={width}:{height},fps={CAMERA_FPS}',
+               '-an', '-progress', 'pipe:2'] + codec_args + ['pipe:1']
+    cpu_before = children_cpu_seconds()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    total_bytes = 0
+    while True:
+        data = process.stdout.read(65536)
+        if not data:
+            break
+        total_bytes += len(data)
+    progress = process.stderr.read().decode(errors='replace')
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed: {progress.strip()}")
+    frames = 0
+    for line in progress.splitlines():
+        if line.startswith('frame='):
+            frames = int(line.split('=', 1)[1])
+    return frames, total_bytes, children_cpu_seconds() - cpu_before
+
+def benchmark_stream(args):
+    """Compare bytes per second and CPU of MJPEG and H.264 on recorded footage"""
+    h264_codec = args.h264_codec
+    if h264_codec is None:
+        # Prefer the hardware encoder picamera2's H264Encoder uses on the Pi
+        h264_codec = 'h264_v4l2m2m' if ffmpeg_has_encoder('h264_v4l2m2m') else 'libx264'
+    h264_args = ['-c:v', h264_codec, '-b:v', str(H264_BITRATE), '-g', str(H264_KEYFRAME_INTERVAL)]
+    if h264_codec == 'libx264':
+        h264_args += ['-preset', 'ultrafast', '-tune', 'zerolatency']
+
+    modes = [
+        ('decode only', ['-f', 'null']),
+        ('mjpeg', ['-c:v', args.mjpeg_codec, '-q:v', str(args.mjpeg_quality), '-f', 'mjpeg']),
+        ('h264', h264_args + ['-f', 'h264'])
+    ]
+
+    print(f"Footage: {args.footage} (first {args.seconds}s at "
+          f"{CAMERA_MAIN_SIZE[0]}x{CAMERA_MAIN_SIZE[1]}@{CAMERA_FPS}fps)")
+    results = {}
+    for name, codec_args in modes:
+        frames, total_bytes, cpu = run_ffmpeg(args.footage, args.seconds, codec_args)
+        if frames == 0:
+            print(f"✗ No frames decoded from {args.footage}")
+            return 1
+        video_seconds = frames / CAMERA_FPS
+        results[name] = (frames, total_bytes / video_seconds, cpu / video_seconds)
+
+    # Decoding the footage is common to both modes, so report encode cost net of it
+    decode_cpu = results['decode only'][2]
+    print(f"{'mode':<8} {'frames':>7} {'kB/s':>10} {'Mbit/s':>8} {'CPU s/s':>8} {'net CPU s/s':>12}")
+    for name in ('mjpeg', 'h264'):
+        frames, bytes_per_second, cpu_per_second = results[name]
+        print(f"{name:<8} {frames:>7} {bytes_per_second / 1000:>10.1f} "
+              f"{bytes_per_second * 8 / 1e6:>8.2f} {cpu_per_second:>8.3f} "
+              f"{cpu_per_second - decode_cpu:>12.3f}")
+    ratio = results['mjpeg'][1] / results['h264'][1]
+    print(f"✓ H.264 ({h264_codec}) uses {ratio:.1f}x fewer bytes than MJPEG")
+    return 0
+
+def measure_scan(scan, iterations):
+    """Time scan() and trace its allocations; returns (latencies s, bytes per scan)"""
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        scan()
+        latencies.append(time.perf_counter() - started)
+
+    # Separate pass: tracemalloc slows everything down, so it must not skew timing
+    allocations = []
+    tracemalloc.start()
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        scan()
+        allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return latencies, allocations
+
+def benchmark_qr_capture(args):
+    """Compare the RGB main + cvtColor QR path with the zero-copy lores luma path"""
+    server = load_server()
+    if not server.init_camera():
+        return 1
+
+    def main_rgb_scan():
+        gray, _ = server.capture_gray()
+        server.decode_qr(gray)
+
+    def lores_luma_scan():
+        with server.capture_luma() as (gray, _):
+            server.decode_qr(gray)
+
+    results = {}
+    try:
+        for name, scan in (('main rgb', main_rgb_scan), ('lores luma', lores_luma_scan)):
+            scan()  # warm up
+            results[name] = measure_scan(scan, args.iterations)
+    finally:
+        for profile in server.stream_profiles.values():
+            profile.stop_encoder()
+        server.picam2.stop()
+
+    print(f"{args.iterations} scans per path")
+    print(f"{'path':<12} {'p50 ms':>8} {'p99 ms':>8} {'alloc kB/scan':>14}")
+    for name, (latencies, allocations) in results.items():
+        print(f"{name:<12} {percentile(latencies, 0.5) * 1000:>8.2f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.2f} "
+              f"{sum(allocations) / len(allocations) / 1024:>14.1f}")
+    old_latencies, old_allocations = results['main rgb']
+    new_latencies, new_allocations = results['lores luma']
+    print(f"✓ lores luma saves {(1 - percentile(new_latencies, 0.5) / percentile(old_latencies, 0.5)) * 100:.0f}% "
+          f"p50 latency and {(sum(old_allocations) - sum(new_allocations)) / len(old_allocations) / 1024:.0f} kB "
+          f"of allocation per scan")
+    return 0
+
+def benchmark_qr_backends(args):
+    """Decode rate, latency and recall of each QR backend on recorded frames"""
+    server = load_server()
+    frames, labels = server.load_qr_frames(args.frames)
+    if not frames:
+        print(f"✗ No frames found in {args.frames}")
+        return 1
+    print(f"{len(frames)} frames, recall against "
+          f"{'labels.json' if labels is not None else 'the union of all backends'}")
+    report = server.benchmark_qr_backends(frames, labels, args.backends)
+    server.print_qr_benchmark(report)
+    chosen = server.select_qr_backend(report, args.recall_target)
+    if chosen is None:
+        print(f"✗ No backend reaches {args.recall_target:.0%} recall")
+        return 1
+    print(f"✓ --qr-backend auto would pick {chosen}")
+    return 0
+
+def load_replay_frames(directory):
+    """Recorded frames as (jpeg bytes, grayscale array) pairs in file order.
+
+    .npy dumps are JPEG-encoded once here, so the replay measures fan-out
+    and decoding, not encoding.
+    """
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.lower().endswith(('.jpg', '.jpeg')):
+            with open(path, 'rb') as f:
+                jpeg = f.read()
+            gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        elif name.endswith('.npy'):
+            array = np.load(path)
+            jpeg = cv2.imencode('.jpg', array)[1].tobytes()
+            gray = cv2.cvtColor(array, cv2.COLOR_RGB2GRAY) if array.ndim == 3 else array
+        else:
+            continue
+        if gray is not None:
+            frames.append((jpeg, np.ascontiguousarray(gray, dtype=np.uint8)))
+    return frames
+
+def paced(count, fps):
+    """Yield 0..count-1 on monotonic deadlines fps apart (unthrottled if fps is 0)"""
+    interval = 1 / fps if fps else 0
+    deadline = time.monotonic()
+    for index in range(count):
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield index
+        deadline += interval
+
+def latency_summary(latencies):
+    """p50/p99/max of latencies in seconds, as milliseconds"""
+    if not latencies:
+        return None
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3)
+    }
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def frame_sequence(chunk):
+    """Sequence number from a multipart chunk's X-Frame-Sequence header"""
+    start = chunk.index(b'X-Frame-Sequence: ') + len(b'X-Frame-Sequence: ')
+    return int(chunk[start:chunk.index(b'\r\n', start)])
+
+def replay_stream(server, frames, count, fps, clients):
+    """Feed frames through a StreamProfile to viewers reading via generate_frames()"""
+    height, width = frames[0][1].shape
+    profile = server.StreamProfile('replay', 'main', (width, height))
+    profile.encoder = 'replay'  # frames come from this loop, never start a camera encoder
+    write_started = {}
+    delivery = [[] for _ in range(clients)]
+    received_bytes = [0] * clients
+    ready = threading.Barrier(clients + 1)
+
+    def viewer(index):
+        frames_out = server.generate_frames(profile, f'replay-{index}')
+        ready.wait()
+        for chunk in frames_out:
+            received = time.perf_counter()
+            sequence = frame_sequence(chunk)
+            if sequence not in write_started:
+                break  # the end-of-replay frame
+            delivery[index].append(received - write_started[sequence])
+            received_bytes[index] += len(chunk)
+        frames_out.close()
+
+    threads = [threading.Thread(target=viewer, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    # generate_frames() subscribes on its first next(); let every viewer get there
+    while len(profile.output.clients) < clients:
+        time.sleep(0.001)
+
+    write_times = []
+    started = time.perf_counter()
+    for index in paced(count, fps):
+        jpeg = frames[index % len(frames)][0]
+        write_started[profile.output.sequence + 1] = before = time.perf_counter()
+        profile.output.write(jpeg, timestamp=int(before * 1e6))
+        write_times.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    stats = profile.stats()  # before viewers leave and take their counters along
+    # One frame past the replay, a frame interval later so the last real one
+    # is not skipped as stale, wakes the viewers and tells them to leave
+    time.sleep(1 / fps if fps else 0)
+    profile.output.write(frames[0][0])
+    for thread in threads:
+        thread.join(timeout=server.FRAME_WAIT_TIMEOUT)
+
+    all_delivery = [latency for client in delivery for latency in client]
+    return {
+        'frames_written': count,
+        'clients': clients,
+        'write_fps': round(count / elapsed, 1),
+        'delivered_fps_per_client': round(len(all_delivery) / clients / elapsed, 1),
+        'delivered_bytes_per_second': round(sum(received_bytes) / elapsed),
+        'frames_dropped': sum(client['frames_dropped'] for client in stats['clients']),
+        'latency': {
+            'write': latency_summary(write_times),
+            'delivery': latency_summary(all_delivery)
+        }
+    }
+
+def replay_qr(server, frames, count, fps):
+    """Decode frames with full scans and with the detector's tracking path"""
+    full_scan = []
+    tracked = []
+    detector = server.QRDetector(server.QREventHub())
+    started = time.perf_counter()
+    for index in paced(count, fps):
+        gray = frames[index % len(frames)][1]
+        before = time.perf_counter()
+        server.decode_qr(gray)
+        full_scan.append(time.perf_counter() - before)
+
+        before = time.perf_counter()
+        qr_codes = detector.decode(gray)
+        decode_time = time.perf_counter() - before
+        detector.publish(qr_codes, None, decode_time)
+        tracked.append(decode_time)
+    elapsed = time.perf_counter() - started
+    return {
+        'frames_decoded': count,
+        'backend': server.qr_backend.name,
+        'decode_fps': round(count / elapsed, 1),
+        'full_scans': detector.full_scans,
+        'region_scans': detector.region_scans,
+        'latency': {
+            'full_scan': latency_summary(full_scan),
+            'tracked': latency_summary(tracked)
+        }
+    }
+
+def benchmark_replay(args):
+    """Replay recorded frames through the stream fan-out and QR decode paths"""
+    server = load_server()
+    frames = load_replay_frames(args.frames)
+    if not frames:
+        print(f"✗ No .jpg or .npy frames found in {args.frames}", file=sys.stderr)
+        return 1
+    count = len(frames) * args.loops
+    report = {
+        'frames': args.frames,
+        'unique_frames': len(frames),
+        'size': list(reversed(frames[0][1].shape)),
+        'fps': args.fps,
+        'peak_rss_kb': {'start': peak_rss_kb()}
+    }
+    # The server prints progress to stdout; keep it out of the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        server.set_qr_backend(args.qr_backend or server.QR_FALLBACK_BACKEND)
+        if 'stream' in args.stages:
+            report['stream'] = replay_stream(server, frames, count, args.fps, args.clients)
+            report['peak_rss_kb']['stream'] = peak_rss_kb()
+        if 'qr' in args.stages:
+            report['qr'] = replay_qr(server, frames, count, args.fps)
+            report['peak_rss_kb']['qr'] = peak_rss_kb()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"✓ Replay report written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+def signed_duty_log(gpio, enable_pin, forward_pin, reverse_pin):
+    """(time, signed duty) for every duty change on one wheel of the GPIO log"""
+    levels = {}
+    log = []
+    for at, call, pin, value in gpio.calls:
+        if call == 'output':
+            levels[pin] = value
+        elif call == 'ChangeDutyCycle' and pin == enable_pin:
+            sign = (levels.get(forward_pin) == gpio.HIGH) - (levels.get(reverse_pin) == gpio.HIGH)
+            log.append((at, sign * value))
+    return log
+
+def ramp_limits(log, tick):
+    """Worst slew (%/s) and jerk (%/s²) in a wheel's duty log.
+
+    Unchanged duty is not logged, so each gap is rounded to whole ticks;
+    jerk only uses changes on consecutive ticks.
+    """
+    slews = []
+    for (t1, d1), (t2, d2) in zip(log, log[1:]):
+        ticks = max(1, round((t2 - t1) / tick))
+        slews.append(((d2 - d1) / (ticks * tick), ticks))
+    worst_slew = max((abs(slew) for slew, _ in slews), default=0.0)
+    worst_jerk = max((abs(s2 - s1) / tick for (s1, n1), (s2, n2) in zip(slews, slews[1:])
+                      if n1 == 1 and n2 == 1), default=0.0)
+    return worst_slew, worst_jerk
+
+def idle_tick_cpu(rate, seconds):
+    """CPU share of a thread that only sleeps to fixed-rate deadlines (wake-up cost)"""
+    result = []
+
+    def run():
+        deadline = time.monotonic()
+        ticks = 0
+        while ticks < rate * seconds:
+            deadline += 1 / rate
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            ticks += 1
+        result.append(time.thread_time() / seconds)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result[0]
+
+def benchmark_ramp(args):
+    """CPU use, tick jitter and limit compliance of the motor ramp scheduler"""
+    server = load_server()
+    with contextlib.redirect_stdout(sys.stderr):
+        server.use_simulated_hardware()
+        if not server.init_gpio():
+            return 1
+    ramp = server.motor_ramp
+    ramp.slew = args.slew
+    ramp.jerk = args.jerk
+    ramp.rate_hz = args.rate
+    ramp.start()
+
+    # New random targets every --interval seconds, mostly mid-ramp, with reversals
+    rng = random.Random(args.seed)
+    targets = 0
+    cpu_before = time.process_time()
+    started = time.monotonic()
+    while time.monotonic() - started < args.seconds:
+        server.drive_wheels(rng.uniform(-100, 100), rng.uniform(-100, 100))
+        targets += 1
+        time.sleep(args.interval)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu_before
+    ramp.stop()
+    stats = ramp.stats()
+
+    # Check the limits against what actually reached the (simulated) pins
+    tick = 1 / args.rate
+    wheels = ((server.MOTOR_LEFT_EN, server.MOTOR_LEFT_IN1, server.MOTOR_LEFT_IN2),
+              (server.MOTOR_RIGHT_EN, server.MOTOR_RIGHT_IN3, server.MOTOR_RIGHT_IN4))
+    limits = [ramp_limits(signed_duty_log(server.GPIO, *pins), tick) for pins in wheels]
+    worst_slew = max(slew for slew, _ in limits)
+    worst_jerk = max(jerk for _, jerk in limits)
+    ramp_cpu = stats['cpu_seconds'] / elapsed
+    baseline_cpu = idle_tick_cpu(args.rate, min(args.seconds, 2))
+
+    print(f"{args.seconds:g}s at {args.rate:g} Hz, {targets} targets every {args.interval:g}s "
+          f"(slew {args.slew:g} %/s, jerk {args.jerk:g} %/s²)")
+    print(f"ticks:         {stats['ticks']} ({stats['ticks'] / elapsed:.1f}/s)")
+    print(f"CPU:           {ramp_cpu * 100:.3f}% of one core for the ramp thread "
+          f"({cpu / elapsed * 100:.2f}% whole process; an empty {args.rate:g} Hz "
+          f"sleep loop alone takes {baseline_cpu * 100:.3f}%)")
+    print(f"tick jitter:   p50 {stats.get('jitter_ms_p50')} ms, p99 {stats.get('jitter_ms_p99')} ms, "
+          f"max {stats.get('jitter_ms_max')} ms")
+    print(f"GPIO writes:   {server.GPIO.counts['output']} output, "
+          f"{server.GPIO.counts['ChangeDutyCycle']} ChangeDutyCycle")
+    # Duty is written rounded to 0.1%, which adds 0.1/tick of apparent slew and 0.1/tick² of jerk
+    print(f"worst slew:    {worst_slew:.0f} %/s (limit {args.slew:g})")
+    # Targets too close to brake for are landed on hard, past the jerk limit, not overshot
+    print(f"worst jerk:    {worst_jerk:.0f} %/s² (limit {args.jerk:g} + rounding, "
+          f"exceeded by hard landings)")
+    print(f"tick errors:   {stats['errors']}")
+    if stats['errors']:
+        print("✗ Ramp ticks failed (a duty cycle outside 0-100?)")
+        return 1
+    # Well under 1%: leave headroom for the slower Zero
+    if ramp_cpu >= 0.005:
+        print("✗ Ramp uses 0.5% CPU or more")
+        return 1
+    print("✓ Ramp stays under 0.5% CPU")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stream = commands.add_parser('stream', help='MJPEG vs H.264 bandwidth and CPU')
+    stream.add_argument('footage', help='recorded video file readable by ffmpeg')
+    stream.add_argument('--seconds', type=float, default=30, help='length of footage to use')
+    stream.add_argument('--mjpeg-codec', default='mjpeg', help='ffmpeg MJPEG encoder')
+    stream.add_argument('--mjpeg-quality', type=int, default=5, help='MJPEG -q:v (2-31)')
+    stream.add_argument('--h264-codec', help='ffmpeg H.264 encoder (default: auto)')
+    stream.set_defaults(func=benchmark_stream)
+
+    qr_capture = commands.add_parser('qr-capture', help='QR frame capture paths (on the Pi)')
+    qr_capture.add_argument('--iterations', type=int, default=100, help='scans per path')
+    qr_capture.set_defaults(func=benchmark_qr_capture)
+
+    qr_backends = commands.add_parser('qr-backends', help='QR decoder backends on recorded frames')
+    qr_backends.add_argument('frames', help='directory of .jpg/.png/.npy frames (+ labels.json)')
+    qr_backends.add_argument('--backends', nargs='+', help='backends to compare (default: all)')
+    qr_backends.add_argument('--recall-target', type=float, default=0.95,
+                             help='minimum recall for the pick (default: %(default)s)')
+    qr_backends.set_defaults(func=benchmark_qr_backends)
+
+    replay = commands.add_parser('replay', help='stream and QR paths on recorded frames (no Pi needed)')
+    replay.add_argument('frames', help='directory of .jpg frames or .npy dumps, replayed in name order')
+    replay.add_argument('--fps', type=float, default=CAMERA_FPS,
+                        help='replay rate, 0 for as fast as possible (default: %(default)s)')
+    replay.add_argument('--loops', type=int, default=3, help='times to replay the sequence')
+    replay.add_argument('--clients', type=int, default=3, help='concurrent stream viewers')
+    replay.add_argument('--stages', nargs='+', choices=['stream', 'qr'], default=['stream', 'qr'])
+    replay.add_argument('--qr-backend', help='QR decoder backend (default: the server fallback)')
+    replay.add_argument('--output', help='write the JSON report here instead of stdout')
+    replay.set_defaults(func=benchmark_replay)
+
+    ramp = commands.add_parser('ramp', help='motor ramp scheduler on simulated GPIO')
+    ramp.add_argument('--seconds', type=float, default=10, help='length of the run')
+    ramp.add_argument('--interval', type=float, default=0.3, help='seconds between new targets')
+    ramp.add_argument('--rate', type=float, default=20, help='ramp tick rate in Hz')
+    ramp.add_argument('--slew', type=float, default=250.0, help='max duty change in %%/s')
+    ramp.add_argument('--jerk', type=float, default=2500.0, help='max slew change in %%/s²')
+    ramp.add_argument('--seed', type=int, default=1, help='random target seed')
+    ramp.set_defaults(func=benchmark_ramp)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,20 +6,69 @@ Usage: python3 main.py ( SAME GROUND )
 """
 
 from flask import Flask, Response, render_template_string, request, abort, jsonify
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
-from pyzbar import pyzbar
 import cv2
 import numpy as np
 import io
+import collections
+import json
+import contextlib
+import math
+import mmap
+import os
+import queue
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
 import threading
 import time
 import sys
-from libcamera import Transform
-import RPi.GPIO as GPIO
+import argparse
+import asyncio
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Pi-only: without these the module still imports, e.g. for offline benchmarks
+    from picamera2 import Picamera2, MappedArray
+    from picamera2.encoders import MJPEGEncoder, H264Encoder
+    from picamera2.outputs import Output
+    from libcamera import Transform
+except ImportError:
+    Picamera2 = None
+    Output = object
+
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):  # RuntimeError: not running on a Pi
+    GPIO = None
+
+try:
+    # Optional: needs the zbar shared library; OpenCV can decode QR codes instead
+    from pyzbar import pyzbar
+    from pyzbar.pyzbar import ZBarSymbol
+except ImportError:
+    pyzbar = None
+
+try:
+    # Optional: only needed for the asyncio (ASGI) serving mode
+    import anyio
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.responses import Response as StarletteResponse
+    from starlette.routing import Route, WebSocketRoute
+except ImportError:
+    uvicorn = None
+
+try:
+    # Optional: WebSocket motor control under the Flask server
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 app = Flask(__name__)
+sock = Sock(app) if Sock is not None else None
 
 # Allowed IP range (allow entire local network)
 ALLOWED_NETWORK = "192.168.1."
@@ -37,16 +86,138 @@ MOTOR_RIGHT_EN = 24   # GPIO 24 (PWM)
 # Motor PWM frequency and default speed
 PWM_FREQUENCY = 1000  # 1kHz
 DEFAULT_SPEED = 80    # 80% speed
+# Deadman watchdog: driving motors are stopped when no command or heartbeat
+# arrives for this many seconds (0 disables); the page sends heartbeats
+# MOTOR_HEARTBEATS_PER_WINDOW times per window while a control is held
+MOTOR_WATCHDOG_TIMEOUT = 1.0
+MOTOR_HEARTBEATS_PER_WINDOW = 3
+# Acceleration ramp: per-wheel duty moves toward its target on a fixed tick,
+# at most MOTOR_SLEW_RATE %/s, and the slew itself changes by at most
+# MOTOR_JERK_LIMIT %/s^2; this avoids the current spikes that brown out the
+# Pi on the shared supply (slew 0 = jump straight to the target)
+# (at 20 Hz `benchmark.py ramp` measured ~0.4% of a core on a dev VM, where an
+# empty 20 Hz sleep loop took ~0.2%; not yet measured on a Zero)
+MOTOR_RAMP_HZ = 20
+MOTOR_SLEW_RATE = 250.0   # 0 -> 100% in 0.4s at full slew
+MOTOR_JERK_LIMIT = 2500.0  # full slew reached in 0.1s
+MOTOR_RAMP_STATS_WINDOW = 500  # ticks
+# /drive per-motor trim: each wheel's duty is multiplied by its factor, so
+# lowering the stronger motor's trim makes the robot drive straight
+MOTOR_TRIM_LEFT = 1.0
+MOTOR_TRIM_RIGHT = 1.0
+# Timed trajectories (/trajectory): limits on a submitted list of steps, and
+# the SCHED_FIFO priority asked for the scheduler thread (needs root)
+TRAJECTORY_MAX_STEPS = 100
+TRAJECTORY_MAX_STEP_SECONDS = 30.0
+TRAJECTORY_RT_PRIORITY = 50
+
+# Camera stream sizes; "lores" is also offered as a lighter stream profile
+CAMERA_MAIN_SIZE = (640, 480)
+CAMERA_LORES_SIZE = (320, 240)
+# --hardware sim: frame rate of the simulated camera (see simulated_hardware.py)
+SIM_CAMERA_FPS = 30.0
+
+# Number of recent encoded frames kept for viewers to read from
+FRAME_RING_SIZE = 8
+# H.264 keeps a whole GOP so a lagging viewer can resync at a keyframe
+H264_RING_SIZE = 32
+
+# H.264 mode: bitrate and keyframe interval (new viewers start at a keyframe)
+H264_BITRATE = 1500000  # 1.5 Mbps
+H264_KEYFRAME_INTERVAL = 30  # frames
+# How long a viewer waits for a new frame before checking again
+FRAME_WAIT_TIMEOUT = 5.0
+
+# Background QR detector: target decode rate and number of scans in its stats
+QR_DETECT_RATE_HZ = 2.0
+QR_STATS_WINDOW = 50
+# QR tracking: between full-frame scans only padded crops around recently
+# found codes are decoded; padding is a fraction of the code's size
+QR_FULL_SCAN_INTERVAL = 10  # frames
+QR_TRACK_PADDING = 0.5
+# QR frame source: "pyramid" tries cheap levels first (see below); "lores"
+# decodes the Y plane of the YUV420 lores buffer in place; "main" converts
+# the RGB main stream to grayscale
+QR_SOURCE = 'pyramid'
+# QR pyramid levels, cheapest first: lores Y plane at half and full size
+# (views, no copy), then main converted to gray
+QR_PYRAMID_LEVELS = ('lores/2', 'lores', 'main')
+# Codes smaller than this many pixels at a level are re-checked a level up
+QR_MIN_CODE_PIXELS = 40
+# Every this many frames main is scanned anyway, bounding how long a small
+# far-away code can hide behind large ones found at a cheap level
+QR_PYRAMID_FULL_RES_INTERVAL = 8
+# Frames without any detection before starting at the cheapest level again
+QR_PYRAMID_DECAY = 10
+# Change gate: mean absolute difference (0-255 gray levels) between a small
+# thumbnail of the lores Y plane and the one from the last decoded frame;
+# below this the scene is static and the last QR result is reused (0 = off)
+QR_CHANGE_THRESHOLD = 2.0
+QR_THUMBNAIL_STEP = 8  # thumbnail takes every 8th lores pixel (40x30)
+# Visible-code table: seconds a code stays listed after it was last seen, and
+# how many changes are kept for /scan_qr?since=<cursor> clients
+QR_CODE_TTL = 2.0
+QR_CHANGE_LOG_SIZE = 256
+# Optional QR decoder process pool for multi-core Pis: "auto" uses one worker
+# per core but one, i.e. none on the single-core Zero W; frames are handed to
+# workers through shared-memory slots (QR_POOL_SLOTS_PER_WORKER each)
+QR_POOL_WORKERS = 'auto'
+QR_POOL_SLOTS_PER_WORKER = 2
+# Seconds a pool worker may hold a job before it is taken for hung and
+# restarted, so the in-order results behind the job can carry on
+QR_POOL_JOB_TIMEOUT = 2.0
+# QR decoder backend: "pyzbar" (every zbar symbology), "pyzbar-qr" (zbar
+# limited to QR codes), "opencv" (cv2.QRCodeDetector), or "auto" to benchmark
+# them at startup on the recorded frames in QR_BENCHMARK_DIR and pick the
+# fastest one that finds at least QR_RECALL_TARGET of the codes
+QR_BACKEND = 'auto'
+QR_BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_frames')
+QR_RECALL_TARGET = 0.95
+QR_FALLBACK_BACKEND = 'pyzbar' if pyzbar is not None else 'opencv'
+# Comment sent on idle /qr_events streams so dead connections get noticed
+SSE_KEEPALIVE_INTERVAL = 15.0
+
+# Optional recording (--record) of the main MJPEG stream: frames are appended
+# to segment files closed after RECORDING_SEGMENT_SECONDS or _BYTES, each with
+# an index of RECORDING_INDEX_ENTRY records; the oldest segments are deleted
+# once the recordings take more than the quota
+RECORDING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+RECORDING_SEGMENT_SECONDS = 60
+RECORDING_SEGMENT_BYTES = 64 * 1024 * 1024
+RECORDING_QUOTA_MB = 1024
+# Index record: wall-clock time in microseconds (i64), offset (u64), length (u32)
+RECORDING_INDEX_ENTRY = struct.Struct('<qQI')
+RECORDING_INDEX_DTYPE = np.dtype([('timestamp', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+
+# WebSocket motor control frames (network byte order):
+#   command: command code (u8), speed % (u8), flags (u8), sequence (u16)
+#   ack:     command code (u8), status (u8), sequence (u16)
+CONTROL_FRAME = struct.Struct('!BBBH')
+CONTROL_ACK = struct.Struct('!BBH')
+CONTROL_FLAG_ACK = 0x01
+CONTROL_ACK_OK = 0
+CONTROL_ACK_INVALID = 1
+CONTROL_ACK_ERROR = 2
+CONTROL_COMMANDS = ['stop', 'forward', 'backward', 'left', 'right', 'heartbeat']
 
 # Global PWM objects
 pwm_left = None
 pwm_right = None
 
+# ASGI mode runs every route on one event loop; blocking camera and GPIO
+# calls go to these small executors (one GPIO thread keeps commands ordered)
+camera_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='camera')
+gpio_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gpio')
+
+def is_allowed_address(client_ip):
+    """Check a client address against the allowed network"""
+    return client_ip.startswith(ALLOWED_NETWORK) or client_ip == "127.0.0.1"
+
 @app.before_request
 def limit_remote_addr():
     """Restrict access to only the allowed network"""
     client_ip = request.remote_addr
-    if not (client_ip.startswith(ALLOWED_NETWORK) or client_ip == "127.0.0.1"):
+    if not is_allowed_address(client_ip):
         print(f"✗ Access denied from: {client_ip}")
         abort(403)
 
@@ -70,7 +241,7 @@ HTML_TEMPLATE = """
         h1 {
             margin-bottom: 20px;
         }
-        img {
+        img, canvas {
             max-width: 90%;
             height: auto;
             border: 2px solid #4CAF50;
@@ -234,9 +405,18 @@ HTML_TEMPLATE = """
 </head>
 <body>
     <h1>🤖 Raspberry Pi Camera & Motor Control</h1>
-    <img src="{{ url_for('video_feed') }}" alt="Camera Stream">
+    <img id="stream" src="{{ url_for('video_feed') }}" alt="Camera Stream">
+    <canvas id="h264Stream" width="640" height="480" style="display: none;"></canvas>
     <div class="info">
         <p>Camera: OV5647 Arducam | Resolution: 640x480 @ 30fps</p>
+        <label>Stream:
+            <select id="profileSelect" onchange="setProfile(this.value)">
+                <option value="main">640x480 (main)</option>
+                <option value="lores">320x240 (low bandwidth)</option>
+                <option value="h264">640x480 H.264 (lowest bandwidth)</option>
+            </select>
+        </label>
+        <p id="streamStatus"></p>
     </div>
     
     <div class="motor-controls">
@@ -308,12 +488,74 @@ HTML_TEMPLATE = """
     </div>
 
     <script>
-        let lastQRData = '';
         let currentSpeed = 80;
-        let commandInterval = null;
+        let heartbeatInterval = null;
+        let heldCommand = null;
+        // Keeps the server's motor watchdog fed while a control is held
+        const HEARTBEAT_INTERVAL_MS = {{ heartbeat_ms }};
         let activeKeys = {};  // Track which keys are currently pressed
         
+        // Binary WebSocket control channel (see CONTROL_FRAME in the server)
+        const COMMAND_CODES = {stop: 0, forward: 1, backward: 2, left: 3, right: 4, heartbeat: 5};
+        const CONTROL_FLAG_ACK = 1;
+        // False when the server has no /motor_ws (Flask without flask_sock): POST only
+        const CONTROL_SOCKET_AVAILABLE = {{ control_socket|tojson }};
+        let controlSocket = null;
+        let controlSequence = 0;
+        let pendingAcks = {};
+        
+        function connectControlSocket() {
+            const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+            const socket = new WebSocket(protocol + '//' + location.host + '/motor_ws');
+            socket.binaryType = 'arraybuffer';
+            socket.onopen = () => { controlSocket = socket; };
+            socket.onmessage = (event) => handleAck(event.data);
+            socket.onclose = () => {
+                // Fall back to POST until the socket is back
+                controlSocket = null;
+                pendingAcks = {};
+                setTimeout(connectControlSocket, 2000);
+            };
+        }
+        
+        function describeCommand(command, speed) {
+            switch (command) {
+                case 'forward': return 'Moving forward at ' + speed + '%';
+                case 'backward': return 'Moving backward at ' + speed + '%';
+                case 'left': return 'Turning left at ' + speed + '%';
+                case 'right': return 'Turning right at ' + speed + '%';
+                default: return 'Motors stopped';
+            }
+        }
+        
+        function handleAck(data) {
+            const ack = new DataView(data);
+            const sequence = ack.getUint16(2);
+            const pending = pendingAcks[sequence];
+            if (!pending) return;
+            delete pendingAcks[sequence];
+            const rtt = (performance.now() - pending.sentAt).toFixed(1);
+            document.getElementById('motorStatus').textContent = ack.getUint8(1) === 0
+                ? describeCommand(pending.command, pending.speed) + ' (' + rtt + ' ms)'
+                : 'Error: command rejected';
+        }
+        
         function sendCommand(command) {
+            const heartbeat = command === 'heartbeat';
+            if (controlSocket && controlSocket.readyState === WebSocket.OPEN) {
+                controlSequence = (controlSequence + 1) & 0xffff;
+                const frame = new DataView(new ArrayBuffer(5));
+                frame.setUint8(0, COMMAND_CODES[command]);
+                frame.setUint8(1, currentSpeed);
+                // Heartbeats change nothing worth showing, so skip their acks
+                frame.setUint8(2, heartbeat ? 0 : CONTROL_FLAG_ACK);
+                frame.setUint16(3, controlSequence);
+                if (!heartbeat) {
+                    pendingAcks[controlSequence] = {command: command, speed: currentSpeed, sentAt: performance.now()};
+                }
+                controlSocket.send(frame.buffer);
+                return;
+            }
             fetch('/motor_control', {
                 method: 'POST',
                 headers: {
@@ -326,6 +568,7 @@ HTML_TEMPLATE = """
             })
             .then(response => response.json())
             .then(data => {
+                if (heartbeat) return;
                 document.getElementById('motorStatus').textContent = data.status || 'Command sent';
             })
             .catch(error => {
@@ -335,27 +578,184 @@ HTML_TEMPLATE = """
         }
         
         function startCommand(command) {
-            // Clear any existing interval first
-            if (commandInterval) {
-                clearInterval(commandInterval);
-                commandInterval = null;
+            // Clear any existing heartbeat first
+            if (heartbeatInterval) {
+                clearInterval(heartbeatInterval);
+                heartbeatInterval = null;
             }
-            // Send immediate command
+            // Send the command once, then only heartbeats while button/key is held
+            heldCommand = command;
             sendCommand(command);
-            // Keep sending while button/key is held
-            commandInterval = setInterval(() => sendCommand(command), 100);
+            heartbeatInterval = setInterval(() => sendCommand('heartbeat'), HEARTBEAT_INTERVAL_MS);
         }
         
         function stopCommand() {
-            // Clear the interval to stop repeated commands
-            if (commandInterval) {
-                clearInterval(commandInterval);
-                commandInterval = null;
+            // Stop the heartbeats; the watchdog would stop the motors anyway
+            if (heartbeatInterval) {
+                clearInterval(heartbeatInterval);
+                heartbeatInterval = null;
             }
+            heldCommand = null;
             // Send stop command
             sendCommand('stop');
         }
         
+        let h264Abort = null;
+        let h264Player = null;
+        
+        // Decodes the raw Annex-B stream from /h264_feed with WebCodecs and
+        // draws it on a canvas, so H.264 needs no player library from the internet
+        class H264Player {
+            constructor(canvas) {
+                this.canvas = canvas;
+                this.context = canvas.getContext('2d');
+                this.buffer = new Uint8Array(0);
+                this.unit = [];          // NAL units of the access unit being collected
+                this.unitHasSlice = false;
+                this.unitKey = false;
+                this.frames = 0;
+                this.waitingForKey = true;
+                this.decoder = null;
+            }
+            
+            feed(bytes) {
+                // Every NAL unit is complete once the next start code has arrived
+                const data = new Uint8Array(this.buffer.length + bytes.length);
+                data.set(this.buffer);
+                data.set(bytes, this.buffer.length);
+                let start = -1;
+                let i = 0;
+                while (i + 3 <= data.length) {
+                    if (data[i] === 0 && data[i + 1] === 0 && data[i + 2] === 1) {
+                        if (start >= 0) {
+                            let end = i;
+                            while (end > start && data[end - 1] === 0) end--;  // 4-byte start code
+                            this.nal(data.subarray(start, end));
+                        }
+                        start = i + 3;
+                        i += 3;
+                    } else {
+                        i++;
+                    }
+                }
+                this.buffer = data.slice(start >= 0 ? start - 3 : 0);
+            }
+            
+            nal(nal) {
+                if (!nal.length) return;
+                const type = nal[0] & 0x1f;
+                const slice = type === 1 || type === 5;
+                // A parameter set, AUD or SEI, or a slice starting at macroblock 0
+                // (first_mb_in_slice == 0 codes as a leading 1 bit), begins a new picture
+                if (this.unitHasSlice && (!slice || (nal[1] & 0x80))) this.flush();
+                if (type === 7 && !this.decoder) this.configure(nal);
+                this.unit.push(nal);
+                this.unitHasSlice = this.unitHasSlice || slice;
+                this.unitKey = this.unitKey || type === 5;
+            }
+            
+            configure(sps) {
+                const hex = (byte) => byte.toString(16).padStart(2, '0');
+                this.decoder = new VideoDecoder({
+                    output: (frame) => {
+                        if (this.canvas.width !== frame.displayWidth) this.canvas.width = frame.displayWidth;
+                        if (this.canvas.height !== frame.displayHeight) this.canvas.height = frame.displayHeight;
+                        this.context.drawImage(frame, 0, 0);
+                        frame.close();
+                    },
+                    error: (error) => console.error('H.264 decode error:', error)
+                });
+                // No description: SPS and PPS arrive in-band ahead of every keyframe
+                this.decoder.configure({
+                    codec: 'avc1.' + hex(sps[1]) + hex(sps[2]) + hex(sps[3]),
+                    optimizeForLatency: true
+                });
+            }
+            
+            flush() {
+                const key = this.unitKey;
+                const units = this.unit;
+                this.unit = [];
+                this.unitHasSlice = this.unitKey = false;
+                if (!this.decoder || this.decoder.state !== 'configured') return;
+                // Behind on decoding: skip to the next keyframe rather than lag
+                if (this.decoder.decodeQueueSize > 10) this.waitingForKey = true;
+                if (this.waitingForKey && !key) return;
+                this.waitingForKey = false;
+                const size = units.reduce((total, nal) => total + 4 + nal.length, 0);
+                const data = new Uint8Array(size);
+                let offset = 0;
+                for (const nal of units) {
+                    data.set([0, 0, 0, 1], offset);
+                    data.set(nal, offset + 4);
+                    offset += 4 + nal.length;
+                }
+                this.decoder.decode(new EncodedVideoChunk({
+                    type: key ? 'key' : 'delta',
+                    timestamp: this.frames++ * 33333,
+                    data: data
+                }));
+            }
+            
+            close() {
+                if (this.decoder && this.decoder.state !== 'closed') this.decoder.close();
+                this.decoder = null;
+            }
+        }
+        
+        function setProfile(profile) {
+            stopH264();
+            const img = document.getElementById('stream');
+            if (profile === 'h264') {
+                img.src = '';
+                img.style.display = 'none';
+                startH264();
+                return;
+            }
+            img.style.display = '';
+            img.src = '/video_feed?profile=' + profile;
+        }
+        
+        async function startH264() {
+            // MJPEG stays the fallback when the browser cannot decode H.264
+            try {
+                if (!window.VideoDecoder) {
+                    throw new Error('this browser has no WebCodecs VideoDecoder');
+                }
+                const canvas = document.getElementById('h264Stream');
+                canvas.style.display = '';
+                h264Player = new H264Player(canvas);
+                h264Abort = new AbortController();
+                const response = await fetch('/h264_feed', {signal: h264Abort.signal});
+                const reader = response.body.getReader();
+                while (true) {
+                    const {done, value} = await reader.read();
+                    if (done) break;
+                    h264Player.feed(value);
+                }
+            } catch (error) {
+                if (error.name === 'AbortError') return;
+                console.error('H.264 error:', error);
+                document.getElementById('profileSelect').value = 'main';
+                setProfile('main');
+                document.getElementById('streamStatus').textContent =
+                    'H.264 unavailable (' + error.message + '), showing MJPEG';
+            }
+        }
+        
+        function stopH264() {
+            if (h264Abort) {
+                h264Abort.abort();
+                h264Abort = null;
+            }
+            if (h264Player) {
+                h264Player.close();
+                h264Player = null;
+            }
+            document.getElementById('h264Stream').style.display = 'none';
+            document.getElementById('streamStatus').textContent = '';
+        }
+        
         function updateSpeed(value) {
             currentSpeed = parseInt(value);
             document.getElementById('speedValue').textContent = value + '%';
@@ -367,6 +767,10 @@ HTML_TEMPLATE = """
                 },
                 body: JSON.stringify({ speed: currentSpeed })
             });
+            // Commands are no longer repeated, so apply the new speed to a held one now
+            if (heldCommand) {
+                sendCommand(heldCommand);
+            }
         }
         
         // Keyboard control
@@ -448,37 +852,25 @@ HTML_TEMPLATE = """
             }
         });
         
-        function scanQR() {
-            fetch('/scan_qr')
-                .then(response => response.json())
-                .then(data => {
-                    const resultsDiv = document.getElementById('qr-results');
-                    
-                    if (data.qr_codes && data.qr_codes.length > 0) {
-                        const currentQRData = JSON.stringify(data.qr_codes);
-                        if (currentQRData !== lastQRData) {
-                            lastQRData = currentQRData;
-                            resultsDiv.innerHTML = '';
-                            
-                            data.qr_codes.forEach((qr, index) => {
-                                const resultDiv = document.createElement('div');
-                                resultDiv.className = 'qr-result';
-                                const timestamp = new Date().toLocaleTimeString();
-                                resultDiv.innerHTML = `
-                                    <strong>QR Code ${index + 1}:</strong><br>
-                                    <div style="margin-top: 10px; font-size: 1.1em;">${escapeHtml(qr.data)}</div>
-                                    <div class="qr-timestamp">Type: ${qr.type} | Detected: ${timestamp}</div>
-                                `;
-                                resultsDiv.appendChild(resultDiv);
-                            });
-                        }
-                    } else if (lastQRData !== '') {
-                        lastQRData = '';
-                    }
-                })
-                .catch(error => {
-                    console.error('Error:', error);
+        function showQRCodes(event) {
+            const resultsDiv = document.getElementById('qr-results');
+            
+            // The server only pushes when the set of codes changes
+            if (event.qr_codes.length > 0) {
+                resultsDiv.innerHTML = '';
+                const timestamp = new Date(event.timestamp * 1000).toLocaleTimeString();
+                
+                event.qr_codes.forEach((qr, index) => {
+                    const resultDiv = document.createElement('div');
+                    resultDiv.className = 'qr-result';
+                    resultDiv.innerHTML = `
+                        <strong>QR Code ${index + 1}:</strong><br>
+                        <div style="margin-top: 10px; font-size: 1.1em;">${escapeHtml(qr.data)}</div>
+                        <div class="qr-timestamp">Type: ${qr.type} | Detected: ${timestamp}</div>
+                    `;
+                    resultsDiv.appendChild(resultDiv);
                 });
+            }
         }
         
         function escapeHtml(text) {
@@ -497,33 +889,1705 @@ HTML_TEMPLATE = """
             stopCommand();
         });
         
-        // Start QR scanning
-        setInterval(scanQR, 500);
-        scanQR();
+        if (CONTROL_SOCKET_AVAILABLE) {
+            connectControlSocket();
+        }
+        
+        // Subscribe to QR detection events (EventSource reconnects by itself)
+        const qrEvents = new EventSource('/qr_events');
+        qrEvents.addEventListener('qr', (message) => showQRCodes(JSON.parse(message.data)));
     </script>
 </body>
 </html>
 """
 
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def wake_async_waiters(waiters):
+    """Wake (event loop, future) pairs registered by coroutine readers"""
+    for loop, waiter in waiters:
+        try:
+            loop.call_soon_threadsafe(_wake_waiter, waiter)
+        except RuntimeError:
+            pass  # event loop already closed (server shutting down)
+
+async def wait_async_waiter(owner, loop, waiter, timeout):
+    """Await a future from owner.async_waiters; returns False on timeout"""
+    try:
+        await asyncio.wait_for(waiter, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        if not waiter.done() or waiter.cancelled():
+            with owner.condition:
+                if (loop, waiter) in owner.async_waiters:
+                    owner.async_waiters.remove((loop, waiter))
+
+class EncodedFrame:
+    """One encoded frame as shared by every viewer"""
+    __slots__ = ('sequence', 'timestamp', 'keyframe', 'data', 'chunk')
+
+    def __init__(self, sequence, timestamp, keyframe, data, chunk):
+        self.sequence = sequence    # monotonic, starts at 1
+        self.timestamp = timestamp  # sensor timestamp in microseconds (None if unknown)
+        self.keyframe = keyframe
+        self.data = data            # raw encoded bytes (JPEG or H.264 NAL units)
+        self.chunk = chunk          # bytes ready to send to a viewer
+
+class StreamClient:
+    """Per-viewer cursor and delivery counters"""
+    __slots__ = ('id', 'address', 'connected_at', 'last_sequence', 'synced',
+                 'frames_sent', 'frames_dropped')
+
+    def __init__(self, client_id, address):
+        self.id = client_id
+        self.address = address
+        self.connected_at = time.time()
+        self.last_sequence = 0
+        self.synced = False  # ordered streams: delivering frames in sequence
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def stats(self):
+        total = self.frames_sent + self.frames_dropped
+        return {
+            'id': self.id,
+            'address': self.address,
+            'connected_seconds': round(time.time() - self.connected_at, 1),
+            'last_sequence': self.last_sequence,
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'drop_ratio': round(self.frames_dropped / total, 3) if total else 0.0
+        }
+
 class StreamingOutput(io.BufferedIOBase):
-    """Custom output class for streaming frames"""
+    """Broadcast hub for encoded frames.
+
+    One encoder writes into a bounded ring of recent frames and every viewer
+    reads from it with its own cursor, so N viewers cost a single encode.
+    Each frame is wrapped in its multipart chunk once, on arrival, and all
+    viewers send that same immutable bytes object. Slow viewers always jump
+    to the newest frame and the frames they skip are counted per client.
+
+    With multipart=False frames are passed through as-is (H.264 NAL units),
+    and viewers read them in order through read_next() instead.
+    """
+    def __init__(self, ring_size=FRAME_RING_SIZE, multipart=True):
+        self.multipart = multipart
+        self.sequence = 0
+        self.frames = collections.deque(maxlen=ring_size)
+        self.clients = {}
+        self.next_client_id = 1
+        self.condition = threading.Condition()
+        self.async_waiters = []  # (event loop, future) pairs from read_async()
+
+    @staticmethod
+    def build_chunk(frame, sequence, timestamp):
+        """Frame a JPEG as one multipart/x-mixed-replace part"""
+        header = (b'--FRAME\r\n'
+                  b'Content-Type: image/jpeg\r\n'
+                  b'Content-Length: %d\r\n'
+                  b'X-Frame-Sequence: %d\r\n' % (len(frame), sequence))
+        if timestamp is not None:
+            header += b'X-Timestamp-Us: %d\r\n' % timestamp
+        return b''.join((header, b'\r\n', frame, b'\r\n'))
+
+    def write(self, buf, timestamp=None, keyframe=True):
+        frame = bytes(buf)  # no copy when the encoder already hands us bytes
+        # Only the encoder thread writes, so the sequence can be claimed early
+        sequence = self.sequence + 1
+        chunk = self.build_chunk(frame, sequence, timestamp) if self.multipart else frame
+        encoded = EncodedFrame(sequence, timestamp, keyframe, frame, chunk)
+        with self.condition:
+            self.sequence = sequence
+            self.frames.append(encoded)
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        wake_async_waiters(waiters)
+
+    def latest(self):
+        """Most recent EncodedFrame, or None before the first frame"""
+        with self.condition:
+            return self.frames[-1] if self.frames else None
+
+    def subscribe(self, address):
+        """Register a viewer and return its StreamClient"""
+        with self.condition:
+            client = StreamClient(self.next_client_id, address)
+            client.last_sequence = self.sequence
+            self.next_client_id += 1
+            self.clients[client.id] = client
+            return client
+
+    def unsubscribe(self, client):
+        with self.condition:
+            self.clients.pop(client.id, None)
+
+    def _take_latest(self, client):
+        """Newest frame the client has not seen, or None (lock held)"""
+        if self.sequence <= client.last_sequence:
+            return None
+        return self.frames[-1]
+
+    def _take_next(self, client):
+        """Next frame an ordered-stream client can decode, or None (lock held)"""
+        if not self.frames or self.sequence <= client.last_sequence:
+            return None
+        oldest = self.frames[0].sequence
+        if client.synced and client.last_sequence + 1 >= oldest:
+            return self.frames[client.last_sequence + 1 - oldest]
+        # New or fallen out of the ring: resume at the newest unseen keyframe
+        client.synced = False
+        for frame in reversed(self.frames):
+            if frame.sequence <= client.last_sequence:
+                break
+            if frame.keyframe:
+                client.synced = True
+                return frame
+        return None
+
+    @staticmethod
+    def _deliver(client, frame):
+        """Advance a client's cursor to frame, counting skipped frames (lock held)"""
+        if client.frames_sent:
+            client.frames_dropped += frame.sequence - client.last_sequence - 1
+        client.last_sequence = frame.sequence
+        client.frames_sent += 1
+        return frame
+
+    def _read(self, take, client, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                frame = take(client)
+                if frame is not None:
+                    return self._deliver(client, frame)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def read_latest(self, client, timeout=None):
+        """Return the newest EncodedFrame this client has not seen yet.
+
+        Blocks until a newer frame exists or timeout expires (returns None).
+        Frames published since the client's previous read are skipped and
+        added to its drop counter.
+        """
+        return self._read(self._take_latest, client, timeout)
+
+    def read_next(self, client, timeout=None):
+        """Return the next EncodedFrame for a viewer of an inter-coded stream.
+
+        Frames are delivered in order because H.264 P-frames cannot be
+        skipped. A viewer that joins, or falls out of the ring, resyncs at
+        the next keyframe; frames skipped that way count as drops.
+        """
+        return self._read(self._take_next, client, timeout)
+
+    async def read_async(self, client, timeout=None, ordered=False):
+        """Coroutine version of read_latest()/read_next() for the ASGI server.
+
+        Waits on an event-loop future woken by write() instead of parking
+        an OS thread in condition.wait().
+        """
+        loop = asyncio.get_running_loop()
+        take = self._take_next if ordered else self._take_latest
+        while True:
+            with self.condition:
+                frame = take(client)
+                if frame is not None:
+                    return self._deliver(client, frame)
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            if not await wait_async_waiter(self, loop, waiter, timeout):
+                return None
+
+    def stats(self):
+        with self.condition:
+            latest = self.frames[-1] if self.frames else None
+            return {
+                'sequence': self.sequence,
+                'timestamp': latest.timestamp if latest else None,
+                'clients': [c.stats() for c in self.clients.values()]
+            }
+
+class StreamProfile:
+    """An encoded camera stream (MJPEG or H.264) that viewers can pick by name.
+
+    Always-on profiles keep their encoder running from startup. On-demand
+    profiles start their encoder for the first viewer and stop it when the
+    last one leaves, so an unwatched profile costs nothing.
+    """
+    def __init__(self, name, stream, size, codec='mjpeg', on_demand=False):
+        self.name = name
+        self.stream = stream  # picamera2 stream the encoder reads from
+        self.size = size
+        self.codec = codec
+        self.on_demand = on_demand
+        if codec == 'h264':
+            self.output = StreamingOutput(H264_RING_SIZE, multipart=False)
+        else:
+            self.output = StreamingOutput()
+        self.encoder = None
+        self.viewers = 0
+        self.lock = threading.Lock()
+
+    def start_encoder(self):
+        if self.codec == 'h264':
+            # Inline SPS/PPS with every keyframe so viewers can join mid-stream
+            self.encoder = H264Encoder(bitrate=H264_BITRATE, repeat=True,
+                                       iperiod=H264_KEYFRAME_INTERVAL)
+        else:
+            self.encoder = MJPEGEncoder()
+        picam2.start_encoder(self.encoder, EncoderOutput(self.output), name=self.stream)
+        print(f"✓ Started '{self.name}' {self.codec} encoder ({self.size[0]}x{self.size[1]})")
+
+    def stop_encoder(self):
+        if self.encoder is not None:
+            picam2.stop_encoder(self.encoder)
+            self.encoder = None
+            print(f"✓ Stopped '{self.name}' encoder")
+
+    def subscribe(self, address):
+        with self.lock:
+            self.viewers += 1
+            if self.encoder is None:
+                self.start_encoder()
+        return self.output.subscribe(address)
+
+    def read(self, client, timeout=None):
+        if self.codec == 'h264':
+            return self.output.read_next(client, timeout)
+        return self.output.read_latest(client, timeout)
+
+    async def read_async(self, client, timeout=None):
+        return await self.output.read_async(client, timeout, ordered=self.codec == 'h264')
+
+    def unsubscribe(self, client):
+        self.output.unsubscribe(client)
+        with self.lock:
+            self.viewers -= 1
+            if self.viewers == 0 and self.on_demand:
+                self.stop_encoder()
+
+    def stats(self):
+        stats = self.output.stats()
+        stats.update({
+            'codec': self.codec,
+            'size': list(self.size),
+            'encoding': self.encoder is not None
+        })
+        return stats
+
+class EncoderOutput(Output):
+    """picamera2 output passing each encoded frame and its sensor timestamp on"""
+    def __init__(self, streaming_output):
+        super().__init__()
+        self.streaming_output = streaming_output
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if self.recording:
+            self.streaming_output.write(frame, timestamp, keyframe)
+
+class RecordingSegment:
+    """One recorded segment: JPEG frames back to back plus their index"""
+    __slots__ = ('start', 'end', 'path', 'index_path', 'frames', 'size')
+
+    def __init__(self, directory, start):
+        self.start = start  # wall-clock microseconds of the first frame
+        self.end = start    # ... and of the last one
+        self.path = os.path.join(directory, f'{start}.mjpeg')
+        self.index_path = os.path.join(directory, f'{start}.idx')
+        self.frames = 0
+        self.size = 0       # bytes on disk, data and index
+
+    def read_index(self):
+        """Index entries written so far, as a RECORDING_INDEX_DTYPE array"""
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        # The writer may be mid-entry on the active segment
+        usable = len(data) - len(data) % RECORDING_INDEX_ENTRY.size
+        return np.frombuffer(data[:usable], dtype=RECORDING_INDEX_DTYPE)
+
+    def info(self):
+        return {
+            'start': self.start / 1e6,
+            'end': self.end / 1e6,
+            'frames': self.frames,
+            'bytes': self.size
+        }
+
+class StreamRecorder:
+    """Records a stream profile's encoded frames into indexed segment files.
+
+    The recorder is one more reader of the profile's StreamingOutput, so
+    it stores exactly the frames viewers get and never encodes anything.
+    Each frame is appended to the current segment with its offset and
+    wall-clock time in the index, which lets playback seek by time.
+    """
+    def __init__(self, profile, directory=RECORDING_DIR, segment_seconds=RECORDING_SEGMENT_SECONDS,
+                 segment_bytes=RECORDING_SEGMENT_BYTES, quota_bytes=RECORDING_QUOTA_MB * 1024 * 1024):
+        self.profile = profile
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.quota_bytes = quota_bytes
+        self.segments = []  # oldest first; the last one is being written
+        self.current = None
+        self.data_file = None
+        self.index_file = None
+        self.client = None
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_segments()
+        self.client = self.profile.subscribe('recorder')
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"✓ Recording '{self.profile.name}' to {self.directory} "
+              f"(quota {self.quota_bytes // (1024 * 1024)} MB)")
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=FRAME_WAIT_TIMEOUT + 1)
+            self.thread = None
+        if self.client is not None:
+            self.profile.unsubscribe(self.client)
+            self.client = None
+        with self.lock:
+            self.close_segment()
+
+    def load_segments(self):
+        """Pick up segments left by earlier runs"""
+        for name in sorted(os.listdir(self.directory), key=lambda n: (len(n), n)):
+            stem, extension = os.path.splitext(name)
+            if extension != '.idx' or not stem.isdigit():
+                continue
+            segment = RecordingSegment(self.directory, int(stem))
+            if not os.path.exists(segment.path):
+                os.remove(segment.index_path)
+                continue
+            entries = segment.read_index()
+            if len(entries):
+                segment.end = int(entries['timestamp'][-1])
+            segment.frames = len(entries)
+            segment.size = os.path.getsize(segment.path) + os.path.getsize(segment.index_path)
+            self.segments.append(segment)
+        self.evict()
+
+    def _run(self):
+        while self.running:
+            frame = self.profile.output.read_next(self.client, timeout=1.0)
+            if frame is None:
+                continue
+            try:
+                self.append(frame.data)
+            except OSError as e:
+                print(f"✗ Recording error: {e}")
+                time.sleep(1)
+
+    def append(self, data):
+        now = time.time_ns() // 1000
+        with self.lock:
+            segment = self.current
+            if (segment is None or now - segment.start >= self.segment_seconds * 1e6
+                    or segment.size + len(data) > self.segment_bytes):
+                segment = self.open_segment(now)
+            offset = self.data_file.tell()
+            self.data_file.write(data)
+            # Data first: an index entry must never point past the data on disk
+            self.data_file.flush()
+            self.index_file.write(RECORDING_INDEX_ENTRY.pack(now, offset, len(data)))
+            self.index_file.flush()
+            segment.end = now
+            segment.frames += 1
+            segment.size += len(data) + RECORDING_INDEX_ENTRY.size
+            if segment.frames == 1:
+                self.evict()
+
+    def open_segment(self, start):
+        """Close the current segment and start a new one (lock held)"""
+        self.close_segment()
+        segment = RecordingSegment(self.directory, start)
+        self.data_file = open(segment.path, 'wb')
+        self.index_file = open(segment.index_path, 'wb')
+        self.segments.append(segment)
+        self.current = segment
+        return segment
+
+    def close_segment(self):
+        for f in (self.data_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.data_file = self.index_file = None
+        self.current = None
+
+    def evict(self):
+        """Delete the oldest segments until the recordings fit the quota"""
+        while len(self.segments) > 1 and sum(s.size for s in self.segments) > self.quota_bytes:
+            segment = self.segments.pop(0)
+            for path in (segment.path, segment.index_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            self.evicted += 1
+            print(f"✓ Recording quota reached, deleted segment {segment.start}")
+
+    def segments_between(self, start, end):
+        """Segments overlapping [start, end] (wall-clock microseconds)"""
+        with self.lock:
+            return [s for s in self.segments if s.frames and s.start <= end and s.end >= start]
+
+    def stats(self):
+        with self.lock:
+            segments = [s.info() for s in self.segments]
+        return {
+            'profile': self.profile.name,
+            'segments': segments,
+            'total_bytes': sum(s['bytes'] for s in segments),
+            'quota_bytes': self.quota_bytes,
+            'segments_evicted': self.evicted,
+            'frames_dropped': self.client.frames_dropped if self.client is not None else 0
+        }
+
+class QREventHub:
+    """Pushes QR detection events to /qr_events listeners.
+
+    Fed by the QRDetector, which publishes only when the set of decoded
+    codes changes, so listeners cost nothing between changes.
+    """
     def __init__(self):
-        self.frame = None
+        self.sequence = 0
+        self.event = None
         self.condition = threading.Condition()
+        self.async_waiters = []
+
+    def current(self):
+        with self.condition:
+            return self.event
 
-    def write(self, buf):
+    def publish(self, result):
         with self.condition:
-            self.frame = buf
+            self.sequence += 1
+            self.event = dict(result, sequence=self.sequence)
             self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        wake_async_waiters(waiters)
+
+    def wait_event(self, after_sequence, timeout=None):
+        """Block until an event newer than after_sequence; None on timeout"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > after_sequence, timeout):
+                return None
+            return self.event
+
+    async def wait_event_async(self, after_sequence, timeout=None):
+        """Coroutine version of wait_event() for the ASGI server"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.sequence > after_sequence:
+                    return self.event
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            if not await wait_async_waiter(self, loop, waiter, timeout):
+                return None
+
+class QRCodeTable:
+    """TTL'd table of currently visible QR codes with stable IDs.
+
+    Codes are keyed by (data, type). Each one keeps its ID while it stays
+    in view, and expires QR_CODE_TTL seconds after it was last seen, so a
+    code missed for a frame or two doesn't flicker out and back in. Every
+    add or expiry bumps a revision, which clients use as a cursor to fetch
+    only the changes since their last request.
+    """
+    def __init__(self, ttl=QR_CODE_TTL):
+        self.ttl = ttl
+        self.entries = {}    # (data, type) -> public entry dict
+        self.deadlines = {}  # (data, type) -> monotonic expiry time
+        self.next_id = 1
+        self.revision = 0
+        self.changes = collections.deque(maxlen=QR_CHANGE_LOG_SIZE)  # (revision, kind, id)
+        self.lock = threading.Lock()
+
+    def update(self, qr_codes):
+        """Merge one scan's codes and expire stale ones; True if anything changed"""
+        now = time.time()
+        now_monotonic = time.monotonic()
+        deadline = now_monotonic + self.ttl
+        revision = self.revision
+        with self.lock:
+            for qr in qr_codes:
+                key = (qr['data'], qr['type'])
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = {
+                        'id': self.next_id,
+                        'data': qr['data'],
+                        'type': qr['type'],
+                        'first_seen': now
+                    }
+                    self.next_id += 1
+                    self.entries[key] = entry
+                    self.revision += 1
+                    self.changes.append((self.revision, 'added', entry['id']))
+                    print(f"✓ QR Code detected: {qr['data']}")
+                entry['rect'] = qr['rect']
+                entry['last_seen'] = now
+                self.deadlines[key] = deadline
+            expired = [key for key, expiry in self.deadlines.items() if expiry < now_monotonic]
+            for key in expired:
+                entry = self.entries.pop(key)
+                del self.deadlines[key]
+                self.revision += 1
+                self.changes.append((self.revision, 'expired', entry['id']))
+            return self.revision != revision
+
+    def visible(self):
+        with self.lock:
+            return [dict(e) for e in self.entries.values()]
+
+    def changes_since(self, cursor):
+        """Codes added, still present and expired since a revision cursor.
+
+        A cursor older than the change log (or 0) gets a full listing with
+        reset set, as if the client had nothing.
+        """
+        with self.lock:
+            oldest = self.changes[0][0] if self.changes else self.revision + 1
+            if cursor <= 0 or cursor < oldest - 1 or cursor > self.revision:
+                return {
+                    'cursor': self.revision,
+                    'reset': True,
+                    'added': [dict(e) for e in self.entries.values()],
+                    'present': [],
+                    'expired': []
+                }
+            added, expired = set(), set()
+            for revision, kind, code_id in self.changes:
+                if revision <= cursor:
+                    continue
+                if kind == 'added':
+                    added.add(code_id)
+                elif code_id in added:
+                    added.discard(code_id)  # came and went since the cursor
+                else:
+                    expired.add(code_id)
+            return {
+                'cursor': self.revision,
+                'reset': False,
+                'added': [dict(e) for e in self.entries.values() if e['id'] in added],
+                'present': [e['id'] for e in self.entries.values() if e['id'] not in added],
+                'expired': sorted(expired)
+            }
+
+class PyzbarBackend:
+    """QR/barcode decoding with zbar, every symbology it supports"""
+    name = 'pyzbar'
+    symbols = None
+
+    def __init__(self):
+        if pyzbar is None:
+            raise RuntimeError("pyzbar or the zbar library is not installed")
+
+    def decode(self, gray):
+        """Decode a grayscale image into (data, type, (left, top, width, height)) tuples"""
+        return [(qr.data.decode('utf-8'), qr.type, tuple(qr.rect))
+                for qr in pyzbar.decode(gray, symbols=self.symbols)]
+
+class PyzbarQRBackend(PyzbarBackend):
+    """zbar limited to QR codes: skips the 1D barcode scanners"""
+    name = 'pyzbar-qr'
+
+    def __init__(self):
+        super().__init__()
+        self.symbols = [ZBarSymbol.QRCODE]
+
+class OpenCVBackend:
+    """QR decoding with OpenCV's QRCodeDetector"""
+    name = 'opencv'
+
+    def __init__(self):
+        self.detector = cv2.QRCodeDetector()
+
+    def decode(self, gray):
+        found, texts, points, _ = self.detector.detectAndDecodeMulti(gray)
+        if not found:
+            return []
+        results = []
+        for text, corners in zip(texts, points):
+            if not text:
+                continue  # located but could not be decoded
+            left, top, width, height = cv2.boundingRect(corners.astype(np.float32))
+            results.append((text, 'QRCODE', (left, top, width, height)))
+        return results
+
+QR_BACKENDS = {backend.name: backend for backend in (PyzbarBackend, PyzbarQRBackend, OpenCVBackend)}
+
+def load_qr_frames(directory):
+    """Load recorded frames (images or .npy arrays) as grayscale, with labels.
+
+    Labels come from labels.json in the same directory, mapping a file name
+    to the list of QR payloads visible in it; None if there is no such file.
+    """
+    frames = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.npy'):
+            frame = np.load(path)
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        elif name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp')):
+            frame = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        else:
+            continue
+        if frame is not None:
+            frames[name] = np.ascontiguousarray(frame, dtype=np.uint8)
+    labels = None
+    labels_path = os.path.join(directory, 'labels.json')
+    if os.path.exists(labels_path):
+        with open(labels_path) as f:
+            labels = {name: set(codes) for name, codes in json.load(f).items()}
+    return frames, labels
+
+def latency_percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def benchmark_qr_backends(frames, labels=None, backends=None):
+    """Run each backend over every frame; returns {name: results dict}.
+
+    recall is the share of expected codes a backend found. Without labels
+    the expected codes of a frame are what any backend found in it, so
+    recall is relative to the best the backends manage together.
+    """
+    found = {}
+    report = {}
+    for name in backends or QR_BACKENDS:
+        try:
+            backend = QR_BACKENDS[name]()
+        except Exception as e:
+            print(f"✗ QR backend {name} unavailable: {e}")
+            continue
+        latencies = []
+        found[name] = {}
+        for frame_name, frame in frames.items():
+            started = time.perf_counter()
+            try:
+                codes = backend.decode(frame)
+            except Exception as e:
+                print(f"✗ QR backend {name} failed on {frame_name}: {e}")
+                codes = []
+            latencies.append(time.perf_counter() - started)
+            found[name][frame_name] = {data for data, _, _ in codes}
+        report[name] = {
+            'frames': len(latencies),
+            'decode_hz': round(len(latencies) / sum(latencies), 1) if latencies else 0.0,
+            'p50_ms': round(latency_percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'p99_ms': round(latency_percentile(latencies, 0.99) * 1000, 2) if latencies else None
+        }
+
+    if labels is None:
+        labels = {frame_name: set().union(*(codes[frame_name] for codes in found.values()))
+                  for frame_name in frames}
+    expected = sum(len(labels.get(frame_name, ())) for frame_name in frames)
+    for name, codes in found.items():
+        hits = sum(len(codes[frame_name] & labels.get(frame_name, set())) for frame_name in frames)
+        report[name]['recall'] = round(hits / expected, 3) if expected else 1.0
+    return report
+
+def select_qr_backend(report, recall_target=QR_RECALL_TARGET):
+    """Fastest backend (by p50) meeting the recall target, or None"""
+    eligible = [name for name, result in report.items()
+                if result['frames'] and result['recall'] >= recall_target]
+    return min(eligible, key=lambda name: report[name]['p50_ms'], default=None)
+
+def print_qr_benchmark(report):
+    print(f"{'backend':<10} {'frames':>7} {'decode/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'recall':>7}")
+    for name, result in report.items():
+        print(f"{name:<10} {result['frames']:>7} {result['decode_hz']:>9} "
+              f"{result['p50_ms']:>8} {result['p99_ms']:>8} {result['recall']:>7.1%}")
+
+def choose_qr_backend(name, directory=QR_BENCHMARK_DIR, recall_target=QR_RECALL_TARGET):
+    """Resolve a --qr-backend value, benchmarking the backends for "auto"."""
+    if name != 'auto':
+        return name
+    if not os.path.isdir(directory):
+        print(f"✗ No recorded QR frames in {directory}, using {QR_FALLBACK_BACKEND}")
+        return QR_FALLBACK_BACKEND
+    frames, labels = load_qr_frames(directory)
+    if not frames:
+        print(f"✗ No recorded QR frames in {directory}, using {QR_FALLBACK_BACKEND}")
+        return QR_FALLBACK_BACKEND
+    print(f"Benchmarking QR backends on {len(frames)} frames "
+          f"({'labelled' if labels is not None else 'unlabelled'})...")
+    report = benchmark_qr_backends(frames, labels)
+    print_qr_benchmark(report)
+    chosen = select_qr_backend(report, recall_target)
+    if chosen is None:
+        print(f"✗ No QR backend reaches {recall_target:.0%} recall, using {QR_FALLBACK_BACKEND}")
+        return QR_FALLBACK_BACKEND
+    return chosen
+
+def set_qr_backend(name):
+    """Make decode_qr use the named backend, or the fallback one if it can't load"""
+    global qr_backend
+    try:
+        qr_backend = QR_BACKENDS[name]()
+    except RuntimeError as e:
+        print(f"✗ QR decoder backend {name} unavailable ({e}), using {QR_FALLBACK_BACKEND}")
+        name = QR_FALLBACK_BACKEND
+        qr_backend = QR_BACKENDS[name]()
+    print(f"✓ QR decoder backend: {name}")
+
+def qr_pool_worker(connection, backend_name):
+    """QR decoder process: decodes frames found in shared-memory slots"""
+    global qr_backend
+    qr_backend = QR_BACKENDS[backend_name]()
+    attached = {}
+    try:
+        while True:
+            job = connection.recv()
+            if job is None:
+                break
+            job_id, slot_name, shape, scale = job
+            if slot_name not in attached:
+                attached[slot_name] = shared_memory.SharedMemory(name=slot_name)
+            gray = np.ndarray(shape, dtype=np.uint8, buffer=attached[slot_name].buf)
+            started = time.perf_counter()
+            try:
+                qr_codes = decode_qr(gray, scale=scale)
+            except Exception as e:
+                print(f"✗ Error scanning QR code: {e}")
+                qr_codes = []
+            del gray  # release the view so the slot can be closed later
+            connection.send((job_id, qr_codes, time.perf_counter() - started))
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        for block in attached.values():
+            block.close()
+
+class QRDecoderPool:
+    """Worker processes decoding QR frames passed through shared memory.
+
+    Each frame is copied once into a free shared-memory slot instead of
+    being pickled; only the slot name and shape cross the worker's pipe.
+    Results come back in any order and are handed to on_result strictly
+    in submission order. When every slot is busy a frame is dropped
+    rather than queued, so decoding never falls behind the camera.
+
+    Every worker has a pipe of its own, so the pool knows which worker
+    holds which job. A worker that dies, or spends longer than
+    QR_POOL_JOB_TIMEOUT on one job (timed from when it could start on
+    it), is replaced, and its jobs are passed on like change-gate skips
+    so the results behind them can carry on.
+    """
+    def __init__(self, workers, on_result, slot_size=CAMERA_MAIN_SIZE[0] * CAMERA_MAIN_SIZE[1]):
+        self.workers = workers
+        self.on_result = on_result
+        self.slot_size = slot_size
+        self.slots = []
+        self.free_slots = queue.Queue()
+        self.processes = []
+        self.connections = []  # parent end of each worker's pipe, by worker position
+        self.collector = None
+        self.next_job = 1
+        self.next_result = 1
+        self.pending = {}   # job id -> (qr_codes, sensor_timestamp, decode_time)
+        self.in_flight = {}  # job id -> (slot index, sensor_timestamp, worker)
+        self.queued = []  # per worker: its job ids, oldest (the one being decoded) first
+        self.head_started = []  # per worker: time.monotonic() its oldest job became current
+        self.dropped = 0
+        self.jobs_lost = 0
+        self.restarts = 0
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        for index in range(self.workers * QR_POOL_SLOTS_PER_WORKER):
+            self.slots.append(shared_memory.SharedMemory(create=True, size=self.slot_size))
+            self.free_slots.put(index)
+        for _ in range(self.workers):
+            process, connection = self._start_worker()
+            self.processes.append(process)
+            self.connections.append(connection)
+            self.queued.append(collections.deque())
+            self.head_started.append(None)
+        self.running = True
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        print(f"✓ QR decoder pool: {self.workers} worker processes, {len(self.slots)} frame slots")
+
+    def _start_worker(self):
+        connection, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=qr_pool_worker, args=(child, qr_backend.name),
+                                          daemon=True)
+        process.start()
+        child.close()  # so recv() sees EOF when the worker dies
+        return process, connection
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            for connection in self.connections:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+        if self.collector is not None:
+            self.collector.join(timeout=2)
+        for process in self.processes:
+            process.join(timeout=2)
+        for connection in self.connections:
+            connection.close()
+        for block in self.slots:
+            block.close()
+            block.unlink()
+        self.processes, self.connections, self.slots = [], [], []
+
+    def submit(self, gray, scale, sensor_timestamp):
+        """Queue a frame for decoding; False if every slot is busy"""
+        try:
+            index = self.free_slots.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        block = self.slots[index]
+        np.copyto(np.ndarray(gray.shape, dtype=np.uint8, buffer=block.buf), gray)
+        with self.lock:
+            job_id = self.next_job
+            self.next_job += 1
+            # Least busy worker; a slot is free, so one of them has room
+            load = [len(jobs) for jobs in self.queued]
+            worker = load.index(min(load))
+            self.in_flight[job_id] = (index, sensor_timestamp, worker)
+            if not self.queued[worker]:
+                self.head_started[worker] = time.monotonic()
+            self.queued[worker].append(job_id)
+            try:
+                self.connections[worker].send((job_id, block.name, gray.shape, scale))
+            except OSError:
+                pass  # the worker just died; the collector replaces it and skips the job
+        return True
+
+    def skip(self, sensor_timestamp):
+        """Slot a frame the change gate skipped into the ordered result stream"""
+        with self.lock:
+            job_id = self.next_job
+            self.next_job += 1
+            self.pending[job_id] = (None, sensor_timestamp, None)
+            self._emit_ready()
+
+    def _collect(self):
+        while self.running:
+            ready = multiprocessing.connection.wait(self.connections, timeout=QR_POOL_JOB_TIMEOUT / 2)
+            with self.lock:
+                if not self.running:
+                    break
+                for connection in ready:
+                    worker = self.connections.index(connection)
+                    try:
+                        job_id, qr_codes, decode_time = connection.recv()
+                    except (EOFError, OSError):
+                        self._replace_worker(worker, 'died')
+                        continue
+                    index, sensor_timestamp, _ = self.in_flight.pop(job_id)
+                    self.free_slots.put(index)
+                    self.pending[job_id] = (qr_codes, sensor_timestamp, decode_time)
+                    # Workers decode in order: the next job's clock starts now
+                    self.queued[worker].remove(job_id)
+                    self.head_started[worker] = time.monotonic() if self.queued[worker] else None
+                now = time.monotonic()
+                hung = [worker for worker, started in enumerate(self.head_started)
+                        if started is not None and now - started >= QR_POOL_JOB_TIMEOUT]
+                for worker in hung:
+                    self._replace_worker(worker, f'hung for {now - self.head_started[worker]:.1f}s')
+                self._emit_ready()
+
+    def _replace_worker(self, worker, reason):
+        """Kill and restart a worker, skipping the jobs it held (lock held)"""
+        process = self.processes[worker]
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+        self.connections[worker].close()
+        print(f"✗ QR decoder worker {process.pid} {reason} (exit code {process.exitcode}), "
+              f"restarting it")
+        for job_id in self.queued[worker]:
+            index, sensor_timestamp, _ = self.in_flight.pop(job_id)
+            self.free_slots.put(index)
+            self.pending[job_id] = (None, sensor_timestamp, None)
+            self.jobs_lost += 1
+        self.queued[worker].clear()
+        self.head_started[worker] = None
+        self.processes[worker], self.connections[worker] = self._start_worker()
+        self.restarts += 1
+
+    def _emit_ready(self):
+        """Hand on every result whose predecessors are all done (lock held)"""
+        while self.next_result in self.pending:
+            self.on_result(*self.pending.pop(self.next_result))
+            self.next_result += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'in_flight': len(self.in_flight),
+                'dropped_busy': self.dropped,
+                'jobs_lost': self.jobs_lost,
+                'worker_restarts': self.restarts
+            }
+
+def resolve_pool_workers(workers):
+    """Turn a --qr-workers value into a process count ("auto": cores - 1)"""
+    if workers == 'auto':
+        return max((os.cpu_count() or 1) - 1, 0)
+    return int(workers)
+
+class QRDetector:
+    """Single background QR decoder with a shared results cache.
+
+    Decodes camera frames at a fixed rate, independent of how many HTTP
+    clients ask, and keeps the latest result so /scan_qr is a dict read.
+    Changes in the set of visible codes are forwarded to a QREventHub.
+
+    With tracking on, frames after a detection only decode padded crops
+    around the codes last seen. A full-frame scan still runs every
+    QR_FULL_SCAN_INTERVAL frames, and whenever a tracked code is lost,
+    so new codes are picked up.
+
+    The pyramid source starts at the level that last found codes and only
+    moves up when nothing is found or a code is too small to trust there.
+
+    A cheap change gate compares a thumbnail of each frame with the last
+    decoded one and skips decoding entirely while the scene is static.
+
+    Results feed a QRCodeTable; the event hub hears about a change only
+    when a code is added to or expires from that table.
+
+    With workers > 0, decoding moves to a QRDecoderPool and several frames
+    are in flight at once. Tracking and pyramid escalation need each
+    result before the next frame, so in that mode whole frames are
+    decoded at one level ("pyramid" uses main, the spare cores pay for it).
+    """
+    def __init__(self, events, rate_hz=QR_DETECT_RATE_HZ, tracking=True, source=QR_SOURCE,
+                 change_threshold=QR_CHANGE_THRESHOLD, workers=0):
+        self.events = events
+        self.workers = workers
+        self.pool = None
+        self.table = QRCodeTable()
+        self.rate_hz = rate_hz
+        self.tracking = tracking
+        self.source = source
+        self.change_threshold = change_threshold
+        self.reference_thumbnail = None
+        self.gate_skips = 0
+        self.gate_time = 0.0
+        self.frame_sequence = 0
+        self.frames_since_full_scan = 0
+        self.full_scans = 0
+        self.region_scans = 0
+        self.tracking_lost = 0
+        self.start_level = 0
+        self.frames_since_top_level = 0
+        self.misses = 0
+        self.level_scans = [0] * len(QR_PYRAMID_LEVELS)
+        self.result = {
+            'qr_codes': [],
+            'count': 0,
+            'timestamp': None,
+            'frame_sequence': 0,
+            'sensor_timestamp': None
+        }
+        self.decode_times = collections.deque(maxlen=QR_STATS_WINDOW)
+        self.scan_times = collections.deque(maxlen=QR_STATS_WINDOW)
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.workers > 0:
+            self.pool = QRDecoderPool(self.workers, self.publish)
+            self.pool.start()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"✓ QR detector running at {self.rate_hz:g} Hz")
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def _run(self):
+        period = 1.0 / self.rate_hz
+        next_scan = time.monotonic()
+        while self.running:
+            try:
+                self.scan_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"✗ Error scanning QR code: {e}")
+            next_scan += period
+            delay = next_scan - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_scan = time.monotonic()  # running behind: don't try to catch up
+
+    def scan_once(self):
+        """Capture and decode one frame, then publish the result"""
+        # Decode straight from the camera buffers while the request is held
+        with capture_frame() as frame:
+            if self.pool is not None:
+                self.submit_to_pool(frame)
+                return
+            if self.scene_unchanged(frame):
+                self.publish(None, frame.sensor_timestamp, None)
+                return
+            started = time.perf_counter()
+            if self.source == 'pyramid':
+                qr_codes = self.decode_pyramid(frame)
+            else:
+                qr_codes = self.decode(*frame.level(QR_PYRAMID_LEVELS.index(self.source)))
+        self.publish(qr_codes, frame.sensor_timestamp, time.perf_counter() - started)
+
+    def submit_to_pool(self, frame):
+        """Pool mode: hand the frame to a worker; the result is published later"""
+        if self.scene_unchanged(frame):
+            self.pool.skip(frame.sensor_timestamp)
+            return
+        source = 'main' if self.source == 'pyramid' else self.source
+        gray, scale = frame.level(QR_PYRAMID_LEVELS.index(source))
+        self.pool.submit(gray, scale, frame.sensor_timestamp)
+
+    def scene_unchanged(self, frame):
+        """Change gate: True when the frame matches the last decoded one"""
+        if not self.change_threshold:
+            return False
+        started = time.perf_counter()
+        thumbnail = frame.thumbnail()
+        unchanged = (self.reference_thumbnail is not None and
+                     np.abs(thumbnail - self.reference_thumbnail).mean() < self.change_threshold)
+        if unchanged:
+            self.gate_skips += 1
+        else:
+            self.reference_thumbnail = thumbnail
+        self.gate_time += time.perf_counter() - started
+        return unchanged
+
+    def decode_pyramid(self, frame):
+        """Decode from the learned start level, moving up only when needed"""
+        top = len(QR_PYRAMID_LEVELS) - 1
+        self.frames_since_top_level += 1
+        probe = self.frames_since_top_level >= QR_PYRAMID_FULL_RES_INTERVAL
+        level = top if probe else self.start_level
+        scans = []
+        while True:
+            gray, scale = frame.level(level)
+            qr_codes, scan = self.decode_level(gray, scale)
+            scans.append(scan)
+            too_small = any(min(qr['rect'][2:]) / scale < QR_MIN_CODE_PIXELS for qr in qr_codes)
+            if (qr_codes and not too_small) or level == top:
+                break
+            level += 1
+        self.count_scan(scans)
+        self.level_scans[level] += 1
+        if level == top:
+            self.frames_since_top_level = 0
+        if probe:
+            return qr_codes
+
+        if qr_codes:
+            # Start here next time, or a level cheaper if every code would
+            # still be big enough there
+            self.misses = 0
+            smallest = min(min(qr['rect'][2:]) for qr in qr_codes)
+            if level > 0 and smallest / CapturedFrame.scale(level - 1) >= QR_MIN_CODE_PIXELS:
+                level -= 1
+            self.start_level = level
+        else:
+            self.misses += 1
+            if self.misses >= QR_PYRAMID_DECAY:
+                self.start_level = 0
+        return qr_codes
+
+    def decode(self, gray, scale=1.0):
+        """Decode one frame at a single level and count the scan"""
+        qr_codes, scan = self.decode_level(gray, scale)
+        self.count_scan([scan])
+        return qr_codes
+
+    def decode_level(self, gray, scale=1.0):
+        """Decode tracked regions when possible, else the whole frame.
+
+        scale maps gray's pixels to main-frame pixels, which rects use.
+        Returns (qr_codes, scan) with scan 'region', 'full', or 'lost'
+        for a full scan after tracking lost a code; the counters are left
+        to count_scan(), so a pyramid frame counts once.
+        """
+        tracked = self.result['qr_codes']
+        if (self.tracking and tracked
+                and self.frames_since_full_scan < QR_FULL_SCAN_INTERVAL):
+            regions = qr_regions(tracked, gray.shape, scale)
+            qr_codes = decode_qr_regions(gray, regions, scale)
+            if len(qr_codes) >= len(tracked):
+                return qr_codes, 'region'
+            return decode_qr(gray, scale=scale), 'lost'
+        return decode_qr(gray, scale=scale), 'full'
+
+    def count_scan(self, scans):
+        """Count one frame's scans (one per level tried) and advance the tracking interval"""
+        if 'lost' in scans:
+            self.tracking_lost += 1
+        if all(scan == 'region' for scan in scans):
+            self.region_scans += 1
+            self.frames_since_full_scan += 1
+        else:
+            self.full_scans += 1
+            self.frames_since_full_scan = 0
+
+    def publish(self, qr_codes, sensor_timestamp, decode_time):
+        """Store a scan result.
+
+        qr_codes and decode_time are None when the change gate skipped
+        decoding; the previous codes are then reused.
+        """
+        with self.lock:
+            if qr_codes is None:
+                qr_codes = self.result['qr_codes']
+            self.frame_sequence += 1
+            self.result = {
+                'qr_codes': qr_codes,
+                'count': len(qr_codes),
+                'timestamp': time.time(),
+                'frame_sequence': self.frame_sequence,
+                'sensor_timestamp': sensor_timestamp
+            }
+            if decode_time is not None:
+                self.decode_times.append(decode_time)
+            self.scan_times.append(time.monotonic())
+        if self.table.update(qr_codes):
+            visible = self.table.visible()
+            self.events.publish({
+                'cursor': self.table.revision,
+                'timestamp': time.time(),
+                'qr_codes': visible,
+                'count': len(visible)
+            })
+
+    def latest(self):
+        with self.lock:
+            return self.result
+
+    def stats(self):
+        with self.lock:
+            decode_times = list(self.decode_times)
+            scan_times = list(self.scan_times)
+            frame_sequence = self.frame_sequence
+        achieved_hz = 0.0
+        if len(scan_times) > 1:
+            achieved_hz = (len(scan_times) - 1) / (scan_times[-1] - scan_times[0])
+        decode_avg = sum(decode_times) / len(decode_times) if decode_times else 0.0
+        return {
+            'source': self.source,
+            'backend': qr_backend.name,
+            'target_hz': self.rate_hz,
+            'achieved_hz': round(achieved_hz, 2),
+            'decode_ms_last': round(decode_times[-1] * 1000, 2) if decode_times else None,
+            'decode_ms_avg': round(decode_avg * 1000, 2) if decode_times else None,
+            'frames_scanned': frame_sequence,
+            'full_scans': self.full_scans,
+            'region_scans': self.region_scans,
+            'tracking_lost': self.tracking_lost,
+            'start_level': QR_PYRAMID_LEVELS[self.start_level],
+            'level_scans': dict(zip(QR_PYRAMID_LEVELS, self.level_scans)),
+            'change_threshold': self.change_threshold,
+            'gate_skips': self.gate_skips,
+            'skip_ratio': round(self.gate_skips / frame_sequence, 3) if frame_sequence else 0.0,
+            # Estimate: skipped frames at the average decode cost, minus the gate itself
+            'cpu_saved_ms': round((self.gate_skips * decode_avg - self.gate_time) * 1000, 1),
+            'pool': self.pool.stats() if self.pool is not None else None,
+            'errors': self.errors
+        }
+
+class MotorState:
+    """Last pin levels and duty cycles applied to the L298N.
+
+    Motor writes go through apply(), which only touches GPIO for values
+    that differ from what the pins already hold, so repeating the same
+    command (a held key) costs no GPIO calls. last_command is refreshed
+    by touch() for every motor command, changed or not.
+    """
+    def __init__(self):
+        self.levels = {}  # direction pin -> GPIO level
+        self.duty = {}    # enable pin -> duty cycle
+        self.pwm = {}     # enable pin -> PWM object
+        self.writes = 0
+        self.writes_avoided = 0
+        self.last_command = None  # time.monotonic() of the last apply() or touch()
+        self.activity = threading.Event()  # set by every touch() and pin write; wakes the watchdog
+        self.lock = threading.RLock()
+
+    def reset(self, pwm, pins):
+        """Start from freshly set-up hardware: pins low, PWM at 0%"""
+        with self.lock:
+            self.pwm = dict(pwm)
+            self.levels = {pin: GPIO.LOW for pin in pins}
+            self.duty = {pin: 0 for pin in pwm}
+
+    def apply(self, levels, duty):
+        """Drive direction pins, then PWM duty cycles, skipping unchanged ones"""
+        with self.lock:
+            for pin, level in levels.items():
+                if self.levels.get(pin) == level:
+                    self.writes_avoided += 1
+                    continue
+                GPIO.output(pin, level)
+                self.levels[pin] = level
+                self.writes += 1
+            for pin, value in duty.items():
+                if self.duty.get(pin) == value:
+                    self.writes_avoided += 1
+                    continue
+                self.pwm[pin].ChangeDutyCycle(value)
+                self.duty[pin] = value
+                self.writes += 1
+                self.activity.set()
+
+    def touch(self):
+        """Note a motor command or heartbeat for the watchdog"""
+        with self.lock:
+            self.last_command = time.monotonic()
+            self.activity.set()
+
+    def moving(self):
+        with self.lock:
+            return any(self.duty.values())
+
+    def stats(self):
+        with self.lock:
+            total = self.writes + self.writes_avoided
+            return {
+                'levels': dict(self.levels),
+                'duty': dict(self.duty),
+                'gpio_writes': self.writes,
+                'gpio_writes_avoided': self.writes_avoided,
+                'avoided_ratio': round(self.writes_avoided / total, 3) if total else 0.0
+            }
+
+class MotorRamp:
+    """Fixed-tick scheduler ramping signed per-wheel duty cycles to targets.
+
+    Duty runs from -100 (full reverse) to 100. Each tick the slew (duty
+    change per second) moves toward the fastest value that can still be
+    braked to zero, within the jerk limit, before reaching the target;
+    so the duty eases in and out. A new target only changes where the
+    ramp heads: the current duty and slew carry on, and a target set too
+    close to brake for within the jerk limit is landed on hard rather
+    than overshot. The direction pins flip on the tick where a wheel's
+    duty passes through zero. The thread sleeps while every wheel is at
+    its target.
+    """
+    WHEELS = ('left', 'right')
+
+    def __init__(self, state, slew=MOTOR_SLEW_RATE, jerk=MOTOR_JERK_LIMIT, rate_hz=MOTOR_RAMP_HZ):
+        self.state = state
+        self.slew = slew
+        self.jerk = jerk
+        self.rate_hz = rate_hz
+        self.target = dict.fromkeys(self.WHEELS, 0.0)
+        self.duty = dict.fromkeys(self.WHEELS, 0.0)
+        self.rate = dict.fromkeys(self.WHEELS, 0.0)  # duty %/s
+        # Direction last written, and the MotorState.levels it went to (reset() replaces it)
+        self.signs = None
+        self.levels_written = None
+        self.ticks = 0
+        self.errors = 0
+        self.lateness = collections.deque(maxlen=MOTOR_RAMP_STATS_WINDOW)  # s past each deadline
+        self.cpu_seconds = 0.0  # CPU time of the scheduler thread
+        # Shares the motor state lock: the watchdog stops the motors while holding it
+        self.wake = threading.Condition(state.lock)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if not self.slew:
+            print("✗ Motor ramping disabled")
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"✓ Motor ramp: {self.rate_hz} Hz, slew {self.slew:g} %/s, jerk {self.jerk:g} %/s²")
+
+    def stop(self):
+        with self.wake:
+            self.running = False
+            self.wake.notify()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def set_targets(self, left, right):
+        """Head toward new signed duty cycles (-100..100)"""
+        with self.wake:
+            self.target['left'] = float(max(-100, min(100, left)))
+            self.target['right'] = float(max(-100, min(100, right)))
+            if not self.running:
+                # No scheduler (ramping off): jump straight there
+                self.duty.update(self.target)
+                self.write()
+            self.wake.notify()
+
+    def halt(self):
+        """Stop both wheels at once, dropping any ramp in progress"""
+        with self.wake:
+            for wheel in self.WHEELS:
+                self.target[wheel] = self.duty[wheel] = self.rate[wheel] = 0.0
+            self.write()
+            self.wake.notify()
+
+    def settled(self):
+        return self.duty == self.target and not any(self.rate.values())
+
+    def step(self, wheel, dt):
+        """Advance one wheel by one tick of dt seconds"""
+        duty = self.duty[wheel]
+        error = self.target[wheel] - duty
+        rate = self.rate[wheel]
+        # Fastest slew that the jerk limit can still bring to zero within the
+        # error, counting in whole ticks of at most max_change each
+        max_change = self.jerk * dt
+        braking = self.jerk * (math.sqrt(dt * dt / 4 + 2 * abs(error) / self.jerk) - dt / 2)
+        desired = math.copysign(min(self.slew, braking), error)
+        rate += max(-max_change, min(max_change, desired - rate))
+        change = rate * dt
+        # Land on the target once this tick reaches it, never past it: an
+        # overshoot could exceed 100% or flip the direction pins on the way
+        # to 0. The slope eases to zero on the next tick when the jerk limit
+        # allows; otherwise it stops here
+        if error and change * error > 0 and abs(change) >= abs(error):
+            landing = error / dt
+            self.duty[wheel] = self.target[wheel]
+            self.rate[wheel] = landing if abs(landing) <= max_change else 0.0
+            return
+        duty += change  # write() flips the pins if this crossed zero
+        if abs(duty) > 100:
+            # Still heading away from a new target lower than the old one
+            duty = math.copysign(100.0, duty)
+            rate = 0.0
+        self.duty[wheel] = duty
+        self.rate[wheel] = rate
+
+    def write(self):
+        """Push the current duty cycles to the pins (state lock held)"""
+        left = round(self.duty['left'], 1)
+        right = round(self.duty['right'], 1)
+        signs = (left > 0) - (left < 0), (right > 0) - (right < 0)
+        # Mid-ramp only the duty changes: leave the direction pins out unless a sign did
+        levels = {}
+        if signs != self.signs or self.state.levels is not self.levels_written:
+            levels = {MOTOR_LEFT_IN1: GPIO.HIGH if left > 0 else GPIO.LOW,
+                      MOTOR_LEFT_IN2: GPIO.HIGH if left < 0 else GPIO.LOW,
+                      MOTOR_RIGHT_IN3: GPIO.HIGH if right > 0 else GPIO.LOW,
+                      MOTOR_RIGHT_IN4: GPIO.HIGH if right < 0 else GPIO.LOW}
+        self.state.apply(levels, {MOTOR_LEFT_EN: abs(left), MOTOR_RIGHT_EN: abs(right)})
+        self.signs = signs
+        self.levels_written = self.state.levels
+
+    def _run(self):
+        interval = 1 / self.rate_hz
+        deadline = None
+        while True:
+            with self.wake:
+                if self.settled():
+                    deadline = None
+                    while self.running and self.settled():
+                        self.wake.wait()
+                if not self.running:
+                    return
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now  # first tick of a ramp runs at once
+                try:
+                    for wheel in self.WHEELS:
+                        if self.duty[wheel] != self.target[wheel] or self.rate[wheel]:
+                            self.step(wheel, interval)
+                    self.write()
+                except Exception as e:
+                    # One failed tick must not end the scheduler: later ticks retry
+                    self.errors += 1
+                    print(f"✗ Motor ramp tick failed: {e}")
+                self.ticks += 1
+                self.lateness.append(now - deadline)
+                if self.ticks % self.rate_hz < 1 or self.settled():
+                    self.cpu_seconds = time.thread_time()  # about once a second
+                # Fixed tick: deadlines don't drift, and a stall skips the ticks it missed
+                deadline += interval
+                if deadline <= now:
+                    deadline = now + interval
+            # Sleep unlocked; a new target is simply picked up by the next tick
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self.wake:
+            lateness = sorted(self.lateness)
+            stats = {
+                'target': dict(self.target),
+                'duty': {wheel: round(duty, 1) for wheel, duty in self.duty.items()},
+                'slew': self.slew,
+                'jerk': self.jerk,
+                'rate_hz': self.rate_hz,
+                'ticks': self.ticks,
+                'errors': self.errors,
+                'cpu_seconds': round(self.cpu_seconds, 3)
+            }
+        if lateness:
+            stats['jitter_ms_p50'] = round(lateness[len(lateness) // 2] * 1000, 3)
+            stats['jitter_ms_p99'] = round(lateness[min(int(len(lateness) * 0.99), len(lateness) - 1)] * 1000, 3)
+            stats['jitter_ms_max'] = round(lateness[-1] * 1000, 3)
+        return stats
+
+class MotorWatchdog:
+    """Deadman switch stopping the motors when commands stop arriving.
+
+    Every motor command or heartbeat refreshes MotorState.last_command.
+    When the motors are driving and nothing has arrived for timeout
+    seconds, the watchdog stops them, so a client that disappears
+    without sending stop cannot leave the robot driving.
+    """
+    def __init__(self, state, timeout=MOTOR_WATCHDOG_TIMEOUT):
+        self.state = state
+        self.timeout = timeout
+        self.trips = 0
+        self.last_trip_late = None  # seconds past the window at the last trip
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def heartbeat_interval(self):
+        """Milliseconds between page heartbeats while a control is held"""
+        timeout = self.timeout or MOTOR_WATCHDOG_TIMEOUT
+        return int(timeout * 1000 / MOTOR_HEARTBEATS_PER_WINDOW)
+
+    def start(self):
+        if not self.timeout:
+            print("✗ Motor watchdog disabled")
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"✓ Motor watchdog: motors stop after {self.timeout:g}s without commands")
+
+    def stop(self):
+        self.stop_event.set()
+        self.state.activity.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            # The state lock keeps a command from slipping in between the check and the stop
+            with self.state.lock:
+                now = time.monotonic()
+                last = self.state.last_command if self.state.last_command is not None else now
+                age = now - last
+                moving = self.state.moving()
+                if not moving:
+                    # Cleared under the lock, so a command from here on sets it again
+                    self.state.activity.clear()
+                elif age >= self.timeout:
+                    stop_motors()
+                    self.trips += 1
+                    self.last_trip_late = age - self.timeout
+                    print(f"✗ Watchdog: last command {age:.2f}s ago, "
+                          f"{self.last_trip_late * 1000:.0f} ms past the {self.timeout:g}s window; "
+                          f"motors stopped")
+                    continue
+            if moving:
+                # Wake by the current deadline; a newer command only moves it later
+                self.stop_event.wait(self.timeout - age)
+            else:
+                # Stopped motors need no deadline: sleep until a command arrives
+                self.state.activity.wait(self.timeout)
+
+    def stats(self):
+        return {
+            'timeout': self.timeout,
+            'trips': self.trips,
+            'last_trip_late_ms': round(self.last_trip_late * 1000, 1)
+                                 if self.last_trip_late is not None else None
+        }
+
+class TrajectoryRunner:
+    """Runs a list of (command, speed, duration) steps on its own thread.
+
+    Step start times are deadlines on the monotonic clock measured from
+    the start of the trajectory, so a late step does not delay the ones
+    after it; each step records how late it actually started. The motors
+    stop after the last step. A new trajectory or any manual command
+    preempts the running one, and the thread keeps the watchdog fed
+    through long steps.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.report = None  # status of the current or last trajectory
+        self.cancel_event = None
+        self.next_id = 1
+
+    def start(self, steps):
+        """Preempt any running trajectory and start steps; returns the new report"""
+        with self.lock:
+            self._cancel('preempted')
+            self.report = {
+                'id': self.next_id,
+                'state': 'running',
+                'priority': None,
+                'steps': [{'command': command, 'speed': speed, 'duration': duration,
+                           'scheduled': None, 'started': None, 'error_ms': None}
+                          for command, speed, duration in steps],
+                'end_error_ms': None
+            }
+            self.next_id += 1
+            self.cancel_event = threading.Event()
+            thread = threading.Thread(target=self._run, args=(self.report, self.cancel_event),
+                                      daemon=True)
+            thread.start()
+            return self.status_locked()
+
+    def cancel(self, reason='cancelled'):
+        """Stop the running trajectory (motors keep their last command); True if one ran"""
+        with self.lock:
+            return self._cancel(reason)
+
+    def _cancel(self, reason):
+        if self.report is None or self.report['state'] != 'running':
+            return False
+        self.report['state'] = reason
+        self.cancel_event.set()
+        return True
+
+    def _wait_until(self, deadline, cancel):
+        """Sleep until a monotonic deadline, feeding the watchdog; False if cancelled"""
+        feed_interval = motor_watchdog.heartbeat_interval() / 1000
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if cancel.wait(min(remaining, feed_interval)):
+                return False
+            motor_state.touch()
+
+    def _run(self, report, cancel):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(TRAJECTORY_RT_PRIORITY))
+            report['priority'] = 'SCHED_FIFO'
+        except (AttributeError, OSError):
+            report['priority'] = 'normal'  # not root, or not Linux
+
+        start = time.monotonic()
+        offset = 0.0
+        for step in report['steps']:
+            if not self._wait_until(start + offset, cancel):
+                return
+            with self.lock:
+                # Checked under the lock: a manual command that preempted us goes after
+                if cancel.is_set():
+                    return
+                started = time.monotonic() - start
+                motor_state.touch()
+                run_motor_command(step['command'], step['speed'])
+            step['scheduled'] = round(offset, 4)
+            step['started'] = round(started, 4)
+            step['error_ms'] = round((started - offset) * 1000, 3)
+            offset += step['duration']
+
+        if not self._wait_until(start + offset, cancel):
+            return
+        with self.lock:
+            if cancel.is_set():
+                return
+            ended = time.monotonic() - start
+            stop_motors()
+            report['end_error_ms'] = round((ended - offset) * 1000, 3)
+            report['state'] = 'done'
+
+    def status(self):
+        with self.lock:
+            return self.status_locked()
+
+    def status_locked(self):
+        if self.report is None:
+            return {'state': 'idle'}
+        status = dict(self.report, steps=[dict(step) for step in self.report['steps']])
+        errors = [abs(step['error_ms']) for step in status['steps'] if step['error_ms'] is not None]
+        status['max_error_ms'] = max(errors) if errors else None
+        return status
 
 # Initialize camera
+hardware = 'real'
 picam2 = None
-output = None
+output = None  # StreamingOutput of the "main" profile
+stream_profiles = {}
+recorder = None  # StreamRecorder with --record
+motor_state = MotorState()
+motor_trim = {'left': MOTOR_TRIM_LEFT, 'right': MOTOR_TRIM_RIGHT}
+motor_ramp = MotorRamp(motor_state)
+motor_watchdog = MotorWatchdog(motor_state)
+trajectory_runner = TrajectoryRunner()
+# Frame sequences restart with the server; this keeps snapshot ETags unique
+instance_id = format(time.time_ns(), 'x')
+qr_backend = QR_BACKENDS[QR_FALLBACK_BACKEND]()  # replaced by set_qr_backend at startup
+qr_events = QREventHub()
+qr_detector = QRDetector(qr_events)
+
+def use_simulated_hardware(fps=SIM_CAMERA_FPS, qr_image_paths=()):
+    """Swap picamera2, libcamera and RPi.GPIO for simulated_hardware stand-ins"""
+    global hardware, Picamera2, MappedArray, MJPEGEncoder, H264Encoder, Transform, GPIO
+    import simulated_hardware as sim
+    sim.SimulatedCamera.fps = fps
+    sim.SimulatedCamera.qr_images = []
+    for path in qr_image_paths:
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print(f"✗ Could not read QR image {path}")
+            continue
+        sim.SimulatedCamera.qr_images.append(image)
+    hardware = 'sim'
+    Picamera2 = sim.SimulatedCamera
+    MappedArray = sim.MappedArray
+    MJPEGEncoder = sim.MJPEGEncoder
+    H264Encoder = sim.H264Encoder
+    Transform = sim.Transform
+    GPIO = sim.SimulatedGPIO()
+    print(f"✓ Simulated hardware: camera at {fps:g} fps, "
+          f"{len(sim.SimulatedCamera.qr_images)} QR images, GPIO calls recorded")
 
 def init_gpio():
     """Initialize GPIO pins for motor control"""
     global pwm_left, pwm_right
     
+    if GPIO is None:
+        print("✗ RPi.GPIO is not available (not running on a Raspberry Pi?)")
+        return False
+    
     try:
         # Clean up any previous GPIO usage
         try:
@@ -550,6 +2614,8 @@ def init_gpio():
         
         pwm_left.start(0)
         pwm_right.start(0)
+        motor_state.reset({MOTOR_LEFT_EN: pwm_left, MOTOR_RIGHT_EN: pwm_right},
+                          [MOTOR_LEFT_IN1, MOTOR_LEFT_IN2, MOTOR_RIGHT_IN3, MOTOR_RIGHT_IN4])
         
         # Ensure motors are stopped initially
         stop_motors()
@@ -568,52 +2634,52 @@ def init_gpio():
         print("  3. Try running with: sudo python3 main.py")
         return False
 
-def set_motor_speed(speed):
-    """Set PWM duty cycle for motor speed (0-100)"""
-    global pwm_left, pwm_right
-    speed = max(0, min(100, speed))  # Clamp between 0-100
-    pwm_left.ChangeDutyCycle(speed)
-    pwm_right.ChangeDutyCycle(speed)
+def drive_wheels(left, right):
+    """Ramp each wheel to a signed duty cycle (-100..100, negative = reverse)"""
+    motor_ramp.set_targets(left, right)
+
+def drive_duty(linear, angular, max_duty=100):
+    """Differential-drive mix: returns signed (left, right) duty cycles.
+
+    linear and angular run from -1 to 1; positive angular turns left. When
+    a wheel would need more than max_duty both are scaled down together,
+    keeping the arc's curvature. Per-motor trim is applied last.
+    """
+    linear = max(-1.0, min(1.0, linear))
+    angular = max(-1.0, min(1.0, angular))
+    left = linear - angular
+    right = linear + angular
+    scale = max(1.0, abs(left), abs(right))
+    return (left / scale * max_duty * motor_trim['left'],
+            right / scale * max_duty * motor_trim['right'])
 
 def stop_motors():
-    """Stop all motors"""
-    GPIO.output(MOTOR_LEFT_IN1, GPIO.LOW)
-    GPIO.output(MOTOR_LEFT_IN2, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN3, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN4, GPIO.LOW)
-    set_motor_speed(0)
+    """Stop all motors (immediately: cutting power needs no ramp)"""
+    motor_ramp.halt()
+
+def clamp_speed(speed):
+    """Clamp a motion speed to 0-100; the direction comes from the command"""
+    return max(0, min(100, speed))
 
 def move_forward(speed=DEFAULT_SPEED):
     """Move forward"""
-    GPIO.output(MOTOR_LEFT_IN1, GPIO.HIGH)
-    GPIO.output(MOTOR_LEFT_IN2, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN3, GPIO.HIGH)
-    GPIO.output(MOTOR_RIGHT_IN4, GPIO.LOW)
-    set_motor_speed(speed)
+    speed = clamp_speed(speed)
+    drive_wheels(speed, speed)
 
 def move_backward(speed=DEFAULT_SPEED):
     """Move backward"""
-    GPIO.output(MOTOR_LEFT_IN1, GPIO.LOW)
-    GPIO.output(MOTOR_LEFT_IN2, GPIO.HIGH)
-    GPIO.output(MOTOR_RIGHT_IN3, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN4, GPIO.HIGH)
-    set_motor_speed(speed)
+    speed = clamp_speed(speed)
+    drive_wheels(-speed, -speed)
 
 def turn_left(speed=DEFAULT_SPEED):
     """Turn left (left motor backward, right motor forward)"""
-    GPIO.output(MOTOR_LEFT_IN1, GPIO.LOW)
-    GPIO.output(MOTOR_LEFT_IN2, GPIO.HIGH)
-    GPIO.output(MOTOR_RIGHT_IN3, GPIO.HIGH)
-    GPIO.output(MOTOR_RIGHT_IN4, GPIO.LOW)
-    set_motor_speed(speed)
+    speed = clamp_speed(speed)
+    drive_wheels(-speed, speed)
 
 def turn_right(speed=DEFAULT_SPEED):
     """Turn right (left motor forward, right motor backward)"""
-    GPIO.output(MOTOR_LEFT_IN1, GPIO.HIGH)
-    GPIO.output(MOTOR_LEFT_IN2, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN3, GPIO.LOW)
-    GPIO.output(MOTOR_RIGHT_IN4, GPIO.HIGH)
-    set_motor_speed(speed)
+    speed = clamp_speed(speed)
+    drive_wheels(speed, -speed)
 
 def check_camera_availability():
     """Check if camera is detected"""
@@ -636,7 +2702,11 @@ def check_camera_availability():
 
 def init_camera():
     """Initialize the camera with optimal settings for Pi Zero W"""
-    global picam2, output
+    global picam2, output, stream_profiles
+    
+    if Picamera2 is None:
+        print("✗ picamera2 is not installed (sudo apt install python3-picamera2)")
+        return False
     
     try:
         if not check_camera_availability():
@@ -646,20 +2716,28 @@ def init_camera():
         print(f"Camera model: {picam2.camera_properties.get('Model', 'Unknown')}")
         
         config = picam2.create_video_configuration(
-            main={"size": (640, 480)},
-            lores={"size": (320, 240)},
+            main={"size": CAMERA_MAIN_SIZE},
+            lores={"size": CAMERA_LORES_SIZE},
             display="lores",
             encode="main",
             transform=Transform(hflip=True, vflip=True)
         )
         picam2.configure(config)
         
-        output = StreamingOutput()
+        stream_profiles = {
+            'main': StreamProfile('main', 'main', CAMERA_MAIN_SIZE),
+            'lores': StreamProfile('lores', 'lores', CAMERA_LORES_SIZE, on_demand=True),
+            'h264': StreamProfile('h264', 'main', CAMERA_MAIN_SIZE, codec='h264', on_demand=True)
+        }
+        output = stream_profiles['main'].output
         
         print("Starting camera...")
         picam2.start()
         time.sleep(2)
         
+        # One encoder per profile for all viewers; clients only read from its output
+        stream_profiles['main'].start_encoder()
+        
         print("✓ Camera initialized successfully (rotated 180°)")
         return True
     except Exception as e:
@@ -668,124 +2746,794 @@ def init_camera():
         traceback.print_exc()
         return False
 
-def generate_frames():
-    """Generator function to yield MJPEG frames"""
-    global output, picam2
-    
-    encoder = MJPEGEncoder()
-    picam2.start_encoder(encoder, FileOutput(output))
-    
+def generate_frames(profile, address):
+    """Generator function to yield encoded frames from a profile's shared encoder"""
+    # Joining or leaving only touches the encoder of an on-demand profile
+    client = profile.subscribe(address)
     try:
         while True:
-            with output.condition:
-                output.condition.wait()
-                frame = output.frame
-            yield (b'--FRAME\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-    except GeneratorExit:
-        picam2.stop_encoder()
+            frame = profile.read(client, timeout=FRAME_WAIT_TIMEOUT)
+            if frame is None:
+                continue
+            # Shared chunk built once per frame by StreamingOutput; no per-client copy
+            yield frame.chunk
+    finally:
+        profile.unsubscribe(client)
+
+def get_stream_profile(name, codec='mjpeg'):
+    """Look up a stream profile by name, or None if it doesn't serve codec"""
+    profile = stream_profiles.get(name)
+    if profile is None or profile.codec != codec:
+        return None
+    return profile
+
+def get_stream_stats():
+    """Per-profile, per-viewer frame delivery and drop counters"""
+    return {name: profile.stats() for name, profile in stream_profiles.items()}
+
+def snapshot(if_none_match=None):
+    """Latest main frame for /snapshot.jpg: (body, status code, headers).
+
+    Serves the JPEG the stream encoder already produced, so it never
+    captures or encodes. The ETag names the frame; a client that sends it
+    back in If-None-Match gets 304 until a newer frame exists.
+    """
+    frame = output.latest() if output is not None else None
+    if frame is None:
+        return b'', 503, {'Retry-After': '1'}
+    etag = f'"{instance_id}-{frame.sequence}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if frame.timestamp is not None:
+        headers['X-Timestamp-Us'] = str(frame.timestamp)
+    if if_none_match and (if_none_match.strip() == '*' or
+                          etag in (tag.strip() for tag in if_none_match.split(','))):
+        return b'', 304, headers
+    return frame.data, 200, headers
+
+def recording_range(params):
+    """Parse /recording query parameters: start and end in unix seconds, speed.
+
+    Returns (start_us, end_us, speed); raises ValueError if they are invalid.
+    """
+    if params.get('start') is None:
+        raise ValueError("start is required")
+    try:
+        start = float(params.get('start'))
+        end = float(params.get('end', start + RECORDING_SEGMENT_SECONDS))
+        speed = float(params.get('speed', 1.0))
+    except ValueError:
+        raise ValueError("start, end and speed must be numbers") from None
+    if end < start or speed < 0:
+        raise ValueError("need start <= end and speed >= 0")
+    return int(start * 1e6), int(end * 1e6), speed
+
+def generate_recording(start, end, speed=1.0):
+    """Generator yielding recorded frames between two wall-clock times (us).
+
+    Frames are found through the segment indexes and sliced out of the
+    memory-mapped segment files. They are paced as recorded, speed times
+    faster; speed 0 sends them as fast as possible.
+    """
+    sequence = 0
+    first_timestamp = None
+    started = time.monotonic()
+    for segment in recorder.segments_between(start, end):
+        try:
+            entries = segment.read_index()
+            timestamps = entries['timestamp']
+            first = np.searchsorted(timestamps, start, 'left')
+            last = np.searchsorted(timestamps, end, 'right')
+            if first >= last:
+                continue
+            with open(segment.path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for timestamp, offset, length in entries[first:last].tolist():
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    if speed:
+                        delay = (timestamp - first_timestamp) / 1e6 / speed - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                    sequence += 1
+                    yield StreamingOutput.build_chunk(mapped[offset:offset + length], sequence, timestamp)
+        except FileNotFoundError:
+            continue  # evicted while we got here
+
+def get_status():
+    """Health check payload"""
+    status = {"status": "running", "camera": "OV5647", "motors": "L298N", "hardware": hardware,
+              "motor_state": motor_state.stats(), "ramp": motor_ramp.stats(),
+              "watchdog": motor_watchdog.stats()}
+    if hardware == 'sim':
+        status["gpio"] = GPIO.stats()
+    return status
+
+def apply_motor_command(command, speed):
+    """Run a manual motor command; returns status text, or None if unknown"""
+    if command in CONTROL_COMMANDS:
+        motor_state.touch()  # every command feeds the watchdog
+        if command != 'heartbeat':
+            trajectory_runner.cancel('preempted')  # the driver takes over
+    return run_motor_command(command, speed)
+
+def run_motor_command(command, speed):
+    """Run a named motor command; returns status text, or None if unknown"""
+    if command in ('forward', 'backward', 'left', 'right'):
+        speed = clamp_speed(speed)  # a negative speed must not reverse the command
+    if command == 'forward':
+        move_forward(speed)
+        return f"Moving forward at {speed}%"
+    elif command == 'backward':
+        move_backward(speed)
+        return f"Moving backward at {speed}%"
+    elif command == 'left':
+        turn_left(speed)
+        return f"Turning left at {speed}%"
+    elif command == 'right':
+        turn_right(speed)
+        return f"Turning right at {speed}%"
+    elif command == 'stop':
+        stop_motors()
+        return "Motors stopped"
+    elif command == 'heartbeat':
+        return "Heartbeat"
+    return None
+
+def handle_motor_control(data):
+    """Apply a motor command; returns (response dict, HTTP status)"""
+    try:
+        command = data.get('command', '').lower()
+        speed = data.get('speed', DEFAULT_SPEED)
+        
+        if command != 'heartbeat':
+            print(f"Motor command: {command} at {speed}% speed")
+        
+        status = apply_motor_command(command, speed)
+        if status is None:
+            return {'success': False, 'error': 'Invalid command'}, 400
+        
+        return {'success': True, 'status': status}, 200
+    except Exception as e:
+        print(f"✗ Error in motor control: {e}")
+        return {'success': False, 'error': str(e)}, 500
+
+def handle_control_frame(frame):
+    """Apply one binary WebSocket control frame; returns ack bytes or None"""
+    if len(frame) != CONTROL_FRAME.size:
+        return None
+    code, speed, flags, sequence = CONTROL_FRAME.unpack(frame)
+    if code >= len(CONTROL_COMMANDS):
+        result = CONTROL_ACK_INVALID
+    else:
+        try:
+            apply_motor_command(CONTROL_COMMANDS[code], speed)
+            result = CONTROL_ACK_OK
+        except Exception as e:
+            print(f"✗ Error in motor control: {e}")
+            result = CONTROL_ACK_ERROR
+    if flags & CONTROL_FLAG_ACK:
+        return CONTROL_ACK.pack(code, result, sequence)
+    return None
+
+def handle_drive(data):
+    """Set wheel targets from linear/angular (-1..1) and optional max speed %
+
+    Returns (response dict, HTTP status).
+    """
+    try:
+        linear = float(data.get('linear', 0))
+        angular = float(data.get('angular', 0))
+        speed = float(data.get('speed', 100))
+    except (AttributeError, TypeError, ValueError):
+        return {'success': False, 'error': 'linear, angular and speed must be numbers'}, 400
+    if not all(math.isfinite(value) for value in (linear, angular, speed)):
+        return {'success': False, 'error': 'linear, angular and speed must be finite'}, 400
+    try:
+        left, right = drive_duty(linear, angular, max(0.0, min(100.0, speed)))
+        motor_state.touch()
+        trajectory_runner.cancel('preempted')
+        drive_wheels(left, right)
+        return {'success': True, 'left': round(left, 1), 'right': round(right, 1)}, 200
+    except Exception as e:
+        print(f"✗ Error in drive: {e}")
+        return {'success': False, 'error': str(e)}, 500
+
+def parse_trajectory(steps):
+    """Validate trajectory steps given as {command, speed, duration} objects
+    or [command, speed, duration] lists; returns (steps, error message)
+    """
+    if not isinstance(steps, list) or not steps:
+        return None, 'steps must be a non-empty list'
+    if len(steps) > TRAJECTORY_MAX_STEPS:
+        return None, f'at most {TRAJECTORY_MAX_STEPS} steps'
+    parsed = []
+    for index, step in enumerate(steps):
+        try:
+            if isinstance(step, dict):
+                command, speed, duration = (step.get('command'), step.get('speed', DEFAULT_SPEED),
+                                            step.get('duration'))
+            else:
+                command, speed, duration = step
+            command = str(command).lower()
+            speed = float(speed)
+            duration = float(duration)
+        except (TypeError, ValueError):
+            return None, f'step {index}: expected command, speed and duration'
+        if command not in CONTROL_COMMANDS or command == 'heartbeat':
+            return None, f'step {index}: invalid command'
+        if not 0 <= speed <= 100:
+            return None, f'step {index}: speed must be 0-100'
+        if not 0 < duration <= TRAJECTORY_MAX_STEP_SECONDS:
+            return None, f'step {index}: duration must be 0-{TRAJECTORY_MAX_STEP_SECONDS:g}s'
+        parsed.append((command, speed, duration))
+    return parsed, None
+
+def handle_trajectory(data):
+    """Start a timed trajectory, preempting any running one
+
+    Returns (response dict, HTTP status).
+    """
+    steps, error = parse_trajectory(data.get('steps') if isinstance(data, dict) else None)
+    if error:
+        return {'success': False, 'error': error}, 400
+    motor_state.touch()
+    status = trajectory_runner.start(steps)
+    print(f"Trajectory {status['id']}: {len(steps)} steps, "
+          f"{sum(duration for _, _, duration in steps):.2f}s")
+    return dict(status, success=True), 200
+
+def handle_trajectory_cancel():
+    """Cancel the running trajectory and stop the motors"""
+    cancelled = trajectory_runner.cancel()
+    stop_motors()
+    return {'success': True, 'cancelled': cancelled}, 200
+
+def handle_motor_speed(data):
+    """Update motor speed; returns (response dict, HTTP status)"""
+    try:
+        speed = data.get('speed', DEFAULT_SPEED)
+        print(f"Speed updated to: {speed}%")
+        return {'success': True, 'speed': speed}, 200
+    except Exception as e:
+        return {'success': False, 'error': str(e)}, 500
+
+class CapturedFrame:
+    """Grayscale pyramid levels of one held camera request, built on first use.
+
+    Levels follow QR_PYRAMID_LEVELS. The lores levels are views into the
+    Y plane of the YUV420 lores buffer: no copy, no colour conversion.
+    """
+    def __init__(self, request, lores):
+        self.request = request
+        self.lores = lores
+        self.sensor_timestamp = request.get_metadata().get('SensorTimestamp')
+        self.levels = {}
+
+    @staticmethod
+    def scale(index):
+        """Factor from a level's pixels to main-frame pixels"""
+        return (CAMERA_MAIN_SIZE[0] / CAMERA_LORES_SIZE[0] * 2,
+                CAMERA_MAIN_SIZE[0] / CAMERA_LORES_SIZE[0],
+                1.0)[index]
+
+    def thumbnail(self):
+        """Small signed copy of the lores Y plane for frame differencing"""
+        width, height = CAMERA_LORES_SIZE
+        return self.lores.array[:height:QR_THUMBNAIL_STEP, :width:QR_THUMBNAIL_STEP].astype(np.int16)
+
+    def level(self, index):
+        """Returns (gray image, scale to main-frame pixels)"""
+        if index not in self.levels:
+            if index == 2:
+                gray = cv2.cvtColor(self.request.make_array('main'), cv2.COLOR_RGB2GRAY)
+            else:
+                # YUV420 planes are stacked vertically; rows may be padded to the stride
+                width, height = CAMERA_LORES_SIZE
+                gray = self.lores.array[:height, :width]
+                if index == 0:
+                    gray = gray[::2, ::2]
+            self.levels[index] = gray
+        return self.levels[index], self.scale(index)
+
+@contextlib.contextmanager
+def capture_frame():
+    """Hold one camera request and yield it as a CapturedFrame.
+
+    Lores views are only valid inside the with block, so decode before
+    leaving it.
+    """
+    request = picam2.capture_request()
+    try:
+        with MappedArray(request, 'lores') as lores:
+            yield CapturedFrame(request, lores)
+    finally:
+        request.release()
+
+def capture_gray():
+    """Capture a frame from the main stream as grayscale.
+
+    Returns (gray image, sensor timestamp in nanoseconds).
+    """
+    request = picam2.capture_request()
+    try:
+        frame = request.make_array('main')
+        sensor_timestamp = request.get_metadata().get('SensorTimestamp')
+    finally:
+        request.release()
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), sensor_timestamp
+
+@contextlib.contextmanager
+def capture_luma():
+    """Y plane of the lores stream as a numpy view into the camera buffer.
+
+    Yields (luma, sensor timestamp in nanoseconds). Nothing is copied or
+    colour-converted; the view is only valid inside the with block.
+    """
+    with capture_frame() as frame:
+        yield frame.level(1)[0], frame.sensor_timestamp
+
+def decode_qr(gray, offset=(0, 0), scale=1.0):
+    """Decode QR codes in a grayscale image into result dicts.
+
+    rect is [left, top, width, height] in main-frame pixels: offset is the
+    position of gray within the frame it was cropped from, and scale maps
+    that frame's pixels to main-frame pixels.
+    """
+    results = []
+    for data, symbology, (left, top, width, height) in qr_backend.decode(gray):
+        results.append({
+            'data': data,
+            'type': symbology,
+            'rect': [round((left + offset[0]) * scale), round((top + offset[1]) * scale),
+                     round(width * scale), round(height * scale)]
+        })
+    return results
+
+def qr_regions(qr_codes, shape, scale=1.0, padding=QR_TRACK_PADDING):
+    """Padded crop boxes (x0, y0, x1, y1) around codes, merged where they overlap.
+
+    Codes carry main-frame rects; boxes are in the pixels of an image of
+    the given shape, which is scale times smaller than the main frame.
+    """
+    height, width = shape[:2]
+    boxes = []
+    for qr in qr_codes:
+        left, top, w, h = (int(v / scale) for v in qr['rect'])
+        pad_x, pad_y = int(w * padding), int(h * padding)
+        boxes.append([max(left - pad_x, 0), max(top - pad_y, 0),
+                      min(left + w + pad_x, width), min(top + h + pad_y, height)])
+    merged = []
+    for box in sorted(boxes):
+        for other in merged:
+            if (box[0] < other[2] and other[0] < box[2]
+                    and box[1] < other[3] and other[1] < box[3]):
+                other[:] = [min(box[0], other[0]), min(box[1], other[1]),
+                            max(box[2], other[2]), max(box[3], other[3])]
+                break
+        else:
+            merged.append(box)
+    return merged
+
+def decode_qr_regions(gray, regions, scale=1.0):
+    """Decode QR codes inside crop boxes of a grayscale frame"""
+    results = []
+    for x0, y0, x1, y1 in regions:
+        results.extend(decode_qr(gray[y0:y1, x0:x1], offset=(x0, y0), scale=scale))
+    return results
+
+def handle_scan_qr(since=None):
+    """Latest cached QR result, or table changes since a cursor"""
+    if since is not None:
+        return dict(qr_detector.table.changes_since(since), success=True)
+    return dict(qr_detector.latest(), success=True)
+
+def format_sse(event):
+    """Encode a QR event as a Server-Sent Events message"""
+    return b'event: qr\ndata: ' + json.dumps(event).encode() + b'\n\n'
+
+def generate_qr_events():
+    """Generator yielding SSE messages whenever the visible QR codes change"""
+    event = qr_events.current()
+    sequence = 0
+    while True:
+        if event is None:
+            yield b': keepalive\n\n'
+        else:
+            sequence = event['sequence']
+            yield format_sse(event)
+        event = qr_events.wait_event(sequence, timeout=SSE_KEEPALIVE_INTERVAL)
 
 @app.route('/')
 def index():
     """Main page with video stream and motor controls"""
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, heartbeat_ms=motor_watchdog.heartbeat_interval(),
+                                  control_socket=sock is not None)
 
 @app.route('/video_feed')
 def video_feed():
-    """Video streaming route"""
-    return Response(generate_frames(),
+    """Video streaming route (?profile=main|lores)"""
+    profile = get_stream_profile(request.args.get('profile', 'main'))
+    if profile is None:
+        return jsonify({'success': False, 'error': 'Invalid profile'}), 400
+    return Response(generate_frames(profile, request.remote_addr),
+                    mimetype='multipart/x-mixed-replace; boundary=FRAME')
+
+@app.route('/h264_feed')
+def h264_feed():
+    """H.264 streaming route: raw Annex-B NAL units over chunked HTTP"""
+    return Response(generate_frames(stream_profiles['h264'], request.remote_addr),
+                    mimetype='video/h264',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/stream_stats')
+def stream_stats():
+    """Per-profile, per-viewer frame delivery and drop counters"""
+    return jsonify(get_stream_stats())
+
+@app.route('/snapshot.jpg')
+def snapshot_jpg():
+    """Most recent frame of the main stream as a still JPEG"""
+    body, code, headers = snapshot(request.headers.get('If-None-Match'))
+    return Response(body, status=code, headers=headers, mimetype='image/jpeg')
+
+@app.route('/recordings')
+def recordings():
+    """Recorded segments (time ranges in unix seconds) and disk usage"""
+    if recorder is None:
+        return jsonify({'success': False, 'error': 'Recording is off (start with --record)'}), 404
+    return jsonify(recorder.stats())
+
+@app.route('/recording')
+def recording():
+    """Play back recorded MJPEG (?start=<unix s>&end=<unix s>&speed=1)"""
+    if recorder is None:
+        return jsonify({'success': False, 'error': 'Recording is off (start with --record)'}), 404
+    try:
+        start, end, speed = recording_range(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return Response(generate_recording(start, end, speed),
                     mimetype='multipart/x-mixed-replace; boundary=FRAME')
 
 @app.route('/motor_control', methods=['POST'])
 def motor_control():
     """Handle motor control commands"""
-    try:
-        data = request.get_json()
-        command = data.get('command', '').lower()
-        speed = data.get('speed', DEFAULT_SPEED)
-        
-        print(f"Motor command: {command} at {speed}% speed")
-        
-        if command == 'forward':
-            move_forward(speed)
-            status = f"Moving forward at {speed}%"
-        elif command == 'backward':
-            move_backward(speed)
-            status = f"Moving backward at {speed}%"
-        elif command == 'left':
-            turn_left(speed)
-            status = f"Turning left at {speed}%"
-        elif command == 'right':
-            turn_right(speed)
-            status = f"Turning right at {speed}%"
-        elif command == 'stop':
-            stop_motors()
-            status = "Motors stopped"
-        else:
-            return jsonify({'success': False, 'error': 'Invalid command'}), 400
-        
-        return jsonify({'success': True, 'status': status})
-    except Exception as e:
-        print(f"✗ Error in motor control: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+    payload, code = handle_motor_control(request.get_json(silent=True))
+    return jsonify(payload), code
+
+@app.route('/drive', methods=['POST'])
+def drive():
+    """Differential drive: {"linear": -1..1, "angular": -1..1, "speed": max %}"""
+    payload, code = handle_drive(request.get_json(silent=True))
+    return jsonify(payload), code
+
+@app.route('/trajectory', methods=['GET', 'POST'])
+def trajectory():
+    """POST {"steps": [[command, speed, seconds], ...]} to run; GET for per-step timing"""
+    if request.method == 'GET':
+        return jsonify(trajectory_runner.status())
+    payload, code = handle_trajectory(request.get_json(silent=True))
+    return jsonify(payload), code
+
+@app.route('/trajectory/cancel', methods=['POST'])
+def trajectory_cancel():
+    """Cancel the running trajectory"""
+    payload, code = handle_trajectory_cancel()
+    return jsonify(payload), code
 
 @app.route('/motor_speed', methods=['POST'])
 def motor_speed():
     """Update motor speed"""
-    try:
-        data = request.get_json()
-        speed = data.get('speed', DEFAULT_SPEED)
-        print(f"Speed updated to: {speed}%")
-        return jsonify({'success': True, 'speed': speed})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+    payload, code = handle_motor_speed(request.get_json(silent=True))
+    return jsonify(payload), code
 
 @app.route('/scan_qr')
 def scan_qr():
-    """Capture image and scan for QR codes"""
-    global picam2
-    
-    try:
-        frame = picam2.capture_array()
-        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        qr_codes = pyzbar.decode(gray)
-        
-        results = []
-        for qr in qr_codes:
-            qr_data = qr.data.decode('utf-8')
-            qr_type = qr.type
-            results.append({
-                'data': qr_data,
-                'type': qr_type
-            })
-            print(f"✓ QR Code detected: {qr_data}")
-        
-        return jsonify({
-            'success': True,
-            'qr_codes': results,
-            'count': len(results)
-        })
-    except Exception as e:
-        print(f"✗ Error scanning QR code: {e}")
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+    """Latest QR codes seen by the background detector (?since=<cursor> for changes)"""
+    return jsonify(handle_scan_qr(request.args.get('since', type=int)))
+
+@app.route('/qr_stats')
+def qr_stats():
+    """QR detector decode time and achieved detection rate"""
+    return jsonify(qr_detector.stats())
+
+@app.route('/qr_events')
+def qr_events_feed():
+    """Server-Sent Events stream of QR detection changes"""
+    return Response(generate_qr_events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 @app.route('/status')
 def status():
     """Health check endpoint"""
-    return {"status": "running", "camera": "OV5647", "motors": "L298N"}
+    return get_status()
+
+def motor_ws(ws):
+    """WebSocket motor control channel (binary CONTROL_FRAME messages)"""
+    print("✓ Motor control socket connected")
+    try:
+        while True:
+            frame = ws.receive()
+            if frame is None:
+                break
+            if isinstance(frame, str):
+                continue
+            ack = handle_control_frame(frame)
+            if ack is not None:
+                ws.send(ack)
+    finally:
+        # Never leave the robot driving after its controller disconnects
+        stop_motors()
+        print("✓ Motor control socket closed, motors stopped")
+
+if sock is not None:
+    sock.route('/motor_ws')(motor_ws)
+
+# ---------------------------------------------------------------------------
+# Asyncio (ASGI) serving mode: same routes as the Flask app above, served as
+# coroutines on one event loop by uvicorn instead of one thread per request.
+# ---------------------------------------------------------------------------
+
+class AllowedNetworkMiddleware:
+    """ASGI counterpart of limit_remote_addr()"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket'):
+            client_ip = scope['client'][0] if scope.get('client') else ''
+            if not is_allowed_address(client_ip):
+                print(f"✗ Access denied from: {client_ip}")
+                if scope['type'] == 'http':
+                    await PlainTextResponse('Forbidden', status_code=403)(scope, receive, send)
+                else:
+                    await send({'type': 'websocket.close', 'code': 1008})
+                return
+        await self.app(scope, receive, send)
+
+async def run_blocking(executor, func, *args):
+    """Run a blocking camera/GPIO call off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def read_json(req):
+    try:
+        return await req.json()
+    except ValueError:
+        return None
+
+async def generate_frames_async(profile, req):
+    """Async generator twin of generate_frames()
+
+    uvicorn drops sends to a client that has gone rather than raising, so
+    the generator checks for the disconnect itself between frames. When
+    Starlette notices first it cancels the response, which would cancel
+    the unsubscribe too; the shield lets that run to the end.
+    """
+    client = await run_blocking(camera_executor, profile.subscribe, req.client.host)
+    try:
+        while not await req.is_disconnected():
+            frame = await profile.read_async(client, timeout=FRAME_WAIT_TIMEOUT)
+            if frame is None:
+                continue
+            yield frame.chunk
+    finally:
+        with anyio.CancelScope(shield=True):
+            await run_blocking(camera_executor, profile.unsubscribe, client)
+
+async def generate_qr_events_async(req):
+    """Async generator twin of generate_qr_events(); ends when the client leaves"""
+    event = qr_events.current()
+    sequence = 0
+    while not await req.is_disconnected():
+        if event is None:
+            yield b': keepalive\n\n'
+        else:
+            sequence = event['sequence']
+            yield format_sse(event)
+        event = await qr_events.wait_event_async(sequence, timeout=SSE_KEEPALIVE_INTERVAL)
+
+def create_asgi_app():
+    """Build the Starlette app for the asyncio serving mode"""
+    # The page only depends on url_for(), so render it once up front
+    with app.test_request_context('/'):
+        index_html = render_template_string(HTML_TEMPLATE,
+                                            heartbeat_ms=motor_watchdog.heartbeat_interval(),
+                                            control_socket=True)
+
+    async def index_async(req):
+        return HTMLResponse(index_html)
+
+    async def video_feed_async(req):
+        profile = get_stream_profile(req.query_params.get('profile', 'main'))
+        if profile is None:
+            return JSONResponse({'success': False, 'error': 'Invalid profile'}, status_code=400)
+        return StreamingResponse(generate_frames_async(profile, req),
+                                 media_type='multipart/x-mixed-replace; boundary=FRAME')
+
+    async def h264_feed_async(req):
+        return StreamingResponse(generate_frames_async(stream_profiles['h264'], req),
+                                 media_type='video/h264',
+                                 headers={'Cache-Control': 'no-cache'})
+
+    async def stream_stats_async(req):
+        return JSONResponse(get_stream_stats())
+
+    async def snapshot_async(req):
+        body, code, headers = snapshot(req.headers.get('if-none-match'))
+        return StarletteResponse(body, status_code=code, headers=headers, media_type='image/jpeg')
+
+    async def recordings_async(req):
+        if recorder is None:
+            return JSONResponse({'success': False, 'error': 'Recording is off (start with --record)'},
+                                status_code=404)
+        return JSONResponse(recorder.stats())
+
+    async def recording_async(req):
+        if recorder is None:
+            return JSONResponse({'success': False, 'error': 'Recording is off (start with --record)'},
+                                status_code=404)
+        try:
+            start, end, speed = recording_range(req.query_params)
+        except ValueError as e:
+            return JSONResponse({'success': False, 'error': str(e)}, status_code=400)
+        # Starlette iterates the blocking generator in its thread pool
+        return StreamingResponse(generate_recording(start, end, speed),
+                                 media_type='multipart/x-mixed-replace; boundary=FRAME')
+
+    async def motor_control_async(req):
+        payload, code = await run_blocking(gpio_executor, handle_motor_control, await read_json(req))
+        return JSONResponse(payload, status_code=code)
+
+    async def drive_async(req):
+        payload, code = await run_blocking(gpio_executor, handle_drive, await read_json(req))
+        return JSONResponse(payload, status_code=code)
+
+    async def trajectory_async(req):
+        if req.method == 'GET':
+            return JSONResponse(trajectory_runner.status())
+        payload, code = await run_blocking(gpio_executor, handle_trajectory, await read_json(req))
+        return JSONResponse(payload, status_code=code)
+
+    async def trajectory_cancel_async(req):
+        payload, code = await run_blocking(gpio_executor, handle_trajectory_cancel)
+        return JSONResponse(payload, status_code=code)
+
+    async def motor_speed_async(req):
+        payload, code = handle_motor_speed(await read_json(req))
+        return JSONResponse(payload, status_code=code)
+
+    async def scan_qr_async(req):
+        since = req.query_params.get('since')
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            since = None  # same as Flask's type=int
+        return JSONResponse(handle_scan_qr(since))
+
+    async def qr_stats_async(req):
+        return JSONResponse(qr_detector.stats())
+
+    async def qr_events_async(req):
+        return StreamingResponse(generate_qr_events_async(req), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache'})
+
+    async def status_async(req):
+        return JSONResponse(get_status())
+
+    async def motor_ws_async(websocket):
+        await websocket.accept()
+        print("✓ Motor control socket connected")
+        try:
+            while True:
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                frame = message.get('bytes')
+                if frame is None:
+                    continue
+                ack = await run_blocking(gpio_executor, handle_control_frame, frame)
+                if ack is not None:
+                    await websocket.send_bytes(ack)
+        finally:
+            # Never leave the robot driving after its controller disconnects
+            await run_blocking(gpio_executor, stop_motors)
+            print("✓ Motor control socket closed, motors stopped")
+
+    routes = [
+        Route('/', index_async),
+        Route('/video_feed', video_feed_async),
+        Route('/h264_feed', h264_feed_async),
+        Route('/stream_stats', stream_stats_async),
+        Route('/snapshot.jpg', snapshot_async),
+        Route('/recordings', recordings_async),
+        Route('/recording', recording_async),
+        Route('/motor_control', motor_control_async, methods=['POST']),
+        Route('/drive', drive_async, methods=['POST']),
+        Route('/trajectory', trajectory_async, methods=['GET', 'POST']),
+        Route('/trajectory/cancel', trajectory_cancel_async, methods=['POST']),
+        Route('/motor_speed', motor_speed_async, methods=['POST']),
+        Route('/scan_qr', scan_qr_async),
+        Route('/qr_stats', qr_stats_async),
+        Route('/qr_events', qr_events_async),
+        Route('/status', status_async),
+        WebSocketRoute('/motor_ws', motor_ws_async)
+    ]
+    return Starlette(routes=routes, middleware=[Middleware(AllowedNetworkMiddleware)])
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Raspberry Pi Camera & Motor Control Server")
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask',
+                        help="flask: threaded dev server; asgi: asyncio event loop via uvicorn")
+    parser.add_argument('--qr-rate', type=float, default=QR_DETECT_RATE_HZ,
+                        help="QR detection rate in Hz (default: %(default)s)")
+    parser.add_argument('--no-qr-tracking', action='store_true',
+                        help="decode the whole frame on every QR scan")
+    parser.add_argument('--qr-source', choices=['pyramid', 'lores', 'main'], default=QR_SOURCE,
+                        help="pyramid: cheapest level that works; lores: zero-copy Y plane "
+                             "of lores; main: RGB main converted to gray")
+    parser.add_argument('--qr-workers', default=QR_POOL_WORKERS,
+                        help="QR decoder worker processes: a number, or auto for one per "
+                             "core but one (0 on a single-core Pi; default: %(default)s)")
+    parser.add_argument('--qr-change-threshold', type=float, default=QR_CHANGE_THRESHOLD,
+                        help="mean gray-level change below which QR decoding is skipped "
+                             "(0 disables; default: %(default)s)")
+    parser.add_argument('--qr-backend', choices=['auto'] + list(QR_BACKENDS), default=QR_BACKEND,
+                        help="QR decoder; auto benchmarks them on --qr-frames at startup "
+                             "(default: %(default)s)")
+    parser.add_argument('--qr-frames', default=QR_BENCHMARK_DIR,
+                        help="recorded frames (+ optional labels.json) for --qr-backend auto")
+    parser.add_argument('--qr-recall-target', type=float, default=QR_RECALL_TARGET,
+                        help="minimum recall for --qr-backend auto (default: %(default)s)")
+    parser.add_argument('--hardware', choices=['real', 'sim'], default='real',
+                        help="sim: simulated camera and GPIO, to run off the Pi")
+    parser.add_argument('--sim-fps', type=float, default=SIM_CAMERA_FPS,
+                        help="simulated camera frame rate (default: %(default)s)")
+    parser.add_argument('--sim-qr', nargs='*', default=[], metavar='IMAGE',
+                        help="QR images shown in turn by the simulated camera")
+    parser.add_argument('--record', action='store_true',
+                        help="record the main stream into segment files (see /recordings)")
+    parser.add_argument('--record-dir', default=RECORDING_DIR,
+                        help="directory for recorded segments (default: %(default)s)")
+    parser.add_argument('--record-quota', type=int, default=RECORDING_QUOTA_MB, metavar='MB',
+                        help="disk space for recordings before the oldest are deleted "
+                             "(default: %(default)s)")
+    parser.add_argument('--watchdog-timeout', type=float, default=MOTOR_WATCHDOG_TIMEOUT,
+                        help="seconds without motor commands before the motors are stopped "
+                             "(0 disables; default: %(default)s)")
+    parser.add_argument('--motor-slew', type=float, default=MOTOR_SLEW_RATE,
+                        help="max duty change in %%/s (0 disables ramping; default: %(default)s)")
+    parser.add_argument('--motor-jerk', type=float, default=MOTOR_JERK_LIMIT,
+                        help="max slew change in %%/s² (default: %(default)s)")
+    parser.add_argument('--trim-left', type=float, default=MOTOR_TRIM_LEFT,
+                        help="/drive duty factor for the left motor (default: %(default)s)")
+    parser.add_argument('--trim-right', type=float, default=MOTOR_TRIM_RIGHT,
+                        help="/drive duty factor for the right motor (default: %(default)s)")
+    args = parser.parse_args()
+    
+    if args.server == 'asgi' and uvicorn is None:
+        print("✗ ASGI mode needs: pip3 install starlette uvicorn")
+        sys.exit(1)
+    
     print("=" * 50)
     print("Raspberry Pi Camera & Motor Control Server")
     print("=" * 50)
     
+    # Pick the QR decoder before any hardware is running, so nothing is left to clean up
+    set_qr_backend(choose_qr_backend(args.qr_backend, args.qr_frames, args.qr_recall_target))
+    
+    if args.hardware == 'sim':
+        use_simulated_hardware(args.sim_fps, args.sim_qr)
+    
     # Initialize GPIO
     if not init_gpio():
         print("\n✗ GPIO initialization failed!")
         sys.exit(1)
+    motor_trim.update(left=args.trim_left, right=args.trim_right)
+    motor_ramp.slew = args.motor_slew
+    motor_ramp.jerk = args.motor_jerk
+    motor_ramp.start()
+    motor_watchdog.timeout = args.watchdog_timeout
+    motor_watchdog.start()
     
     # Initialize camera
     if not init_camera():
@@ -794,6 +3542,19 @@ if __name__ == '__main__':
         print("=" * 50)
         sys.exit(1)
     
+    if args.record:
+        recorder = StreamRecorder(stream_profiles['main'], args.record_dir,
+                                  quota_bytes=args.record_quota * 1024 * 1024)
+        recorder.start()
+    
+    # Start the background QR detector
+    qr_detector.rate_hz = args.qr_rate
+    qr_detector.tracking = not args.no_qr_tracking
+    qr_detector.source = args.qr_source
+    qr_detector.change_threshold = args.qr_change_threshold
+    qr_detector.workers = resolve_pool_workers(args.qr_workers)
+    qr_detector.start()
+    
     # Get the local IP
     import socket
     hostname = socket.gethostname()
@@ -807,16 +3568,28 @@ if __name__ == '__main__':
     print("\n✓ Keyboard controls enabled:")
     print("  → Arrow Keys: Move forward/backward/left/right")
     print("  → Spacebar: Stop")
+    print(f"\n✓ Serving mode: {args.server}")
     print("\nPress Ctrl+C to stop\n")
     
     try:
-        app.run(host='0.0.0.0', port=5000, threaded=True, debug=False)
+        if args.server == 'asgi':
+            uvicorn.run(create_asgi_app(), host='0.0.0.0', port=5000, log_level='warning')
+        else:
+            app.run(host='0.0.0.0', port=5000, threaded=True, debug=False)
     except KeyboardInterrupt:
         print("\n\n✓ Shutting down server...")
     finally:
+        qr_detector.stop()
+        if recorder is not None:
+            recorder.stop()
+        trajectory_runner.cancel()
+        motor_watchdog.stop()
+        motor_ramp.stop()
         stop_motors()
         GPIO.cleanup()
         if picam2:
+            for profile in stream_profiles.values():
+                profile.stop_encoder()
             picam2.stop()
             print("✓ Camera stopped")
         print("✓ Motors stopped")
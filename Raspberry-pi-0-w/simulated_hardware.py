@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Simulated Raspberry Pi hardware for running the camera server off the Pi
+SimulatedCamera stands in for picamera2's Picamera2 and SimulatedGPIO for
+RPi.GPIO, so main-4.py --hardware sim can be load-tested on a laptop.
+Only the calls main-4.py makes are implemented.
+"""
+
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Calls kept in the simulated GPIO log
+GPIO_LOG_SIZE = 100000
+# Seconds each injected QR image stays in view before the next one
+QR_IMAGE_PERIOD = 2.0
+
+class Transform:
+    """libcamera Transform: image flips"""
+    def __init__(self, hflip=False, vflip=False):
+        self.hflip = hflip
+        self.vflip = vflip
+
+class MJPEGEncoder:
+    """JPEG-encodes every frame of its stream with OpenCV"""
+    def __init__(self, quality=85):
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def encode(self, rgb, index, fps):
+        """Returns (encoded frame, keyframe)"""
+        return cv2.imencode('.jpg', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), self.params)[1].tobytes(), True
+
+class H264Encoder:
+    """Stand-in H.264 encoder emitting placeholder NAL units.
+
+    Frames are sized to match the bitrate (keyframes larger) so stream
+    fan-out sees realistic load, but viewers cannot decode them.
+    """
+    def __init__(self, bitrate=1500000, repeat=False, iperiod=30):
+        self.bitrate = bitrate
+        self.iperiod = iperiod
+
+    def encode(self, rgb, index, fps):
+        keyframe = index % self.iperiod == 0
+        size = int(self.bitrate / 8 / fps * (4 if keyframe else 0.9))
+        nal_type = b'\x65' if keyframe else b'\x41'
+        return b'\x00\x00\x00\x01' + nal_type + bytes(size), keyframe
+
+class SimulatedRequest:
+    """A completed camera request holding one frame of every stream"""
+    def __init__(self, buffers, sensor_timestamp):
+        self.buffers = buffers
+        self.metadata = {'SensorTimestamp': sensor_timestamp}
+
+    def make_array(self, name):
+        return self.buffers[name].copy()
+
+    def get_metadata(self):
+        return dict(self.metadata)
+
+    def release(self):
+        pass
+
+class MappedArray:
+    """picamera2 MappedArray: the request's buffer of a stream, uncopied"""
+    def __init__(self, request, stream):
+        self.array = request.buffers[stream]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class SimulatedCamera:
+    """Picamera2 stand-in producing synthetic frames at a fixed rate.
+
+    Main is RGB at the configured size, lores is YUV420 like the real
+    camera. A bar sweeps across the scene so frames keep changing, and
+    each image in qr_images is pasted in turn, QR_IMAGE_PERIOD each.
+    """
+    fps = 30.0
+    qr_images = []  # grayscale arrays
+
+    @staticmethod
+    def global_camera_info():
+        return [{'Model': 'simulated', 'Location': 0, 'Rotation': 0, 'Id': 'sim', 'Num': 0}]
+
+    def __init__(self):
+        self.camera_properties = {'Model': 'simulated'}
+        self.config = None
+        self.encoders = {}  # encoder -> (output, stream name)
+        self.frame_index = 0
+        self.request = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def create_video_configuration(self, main, lores=None, display=None, encode=None,
+                                   transform=None, **kwargs):
+        return {'main': dict(main), 'lores': dict(lores) if lores else None,
+                'transform': transform or Transform()}
+
+    def configure(self, config):
+        self.config = config
+        width, height = config['main']['size']
+        # Horizontal gradient background, rendered once
+        ramp = np.linspace(40, 200, width, dtype=np.uint8)
+        self.background = np.repeat(np.tile(ramp, (height, 1))[:, :, None], 3, axis=2)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def start_encoder(self, encoder, output, name='main'):
+        output.recording = True  # what picamera2's Output.start() does
+        with self.condition:
+            self.encoders[encoder] = (output, name)
+
+    def stop_encoder(self, encoder):
+        with self.condition:
+            output, _ = self.encoders.pop(encoder, (None, None))
+        if output is not None:
+            output.recording = False
+
+    def capture_request(self):
+        """Wait for the next frame"""
+        with self.condition:
+            index = self.frame_index
+            while self.frame_index == index:
+                self.condition.wait()
+            return self.request
+
+    def render(self, index):
+        """Main frame (RGB) for a frame index"""
+        frame = self.background.copy()
+        height, width = frame.shape[:2]
+        bar = int(index * width / (self.fps * 4)) % width  # one sweep every 4s
+        frame[:, bar:bar + width // 32] = 255
+        if self.qr_images:
+            qr = self.qr_images[int(index / (self.fps * QR_IMAGE_PERIOD)) % len(self.qr_images)]
+            qr = qr[:height, :width]
+            top = (height - qr.shape[0]) // 2
+            left = (width - qr.shape[1]) // 2
+            frame[top:top + qr.shape[0], left:left + qr.shape[1]] = qr[:, :, None]
+        transform = self.config['transform']
+        if transform.hflip:
+            frame = frame[:, ::-1]
+        if transform.vflip:
+            frame = frame[::-1]
+        return np.ascontiguousarray(frame)
+
+    def _run(self):
+        interval = 1 / self.fps
+        deadline = time.monotonic()
+        index = 0
+        while self.running:
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            deadline += interval
+
+            main = self.render(index)
+            buffers = {'main': main}
+            if self.config['lores']:
+                lores = cv2.resize(main, tuple(self.config['lores']['size']),
+                                   interpolation=cv2.INTER_AREA)
+                buffers['lores'] = cv2.cvtColor(lores, cv2.COLOR_RGB2YUV_I420)
+            timestamp = time.monotonic_ns()
+            with self.condition:
+                self.request = SimulatedRequest(buffers, timestamp)
+                self.frame_index += 1
+                self.condition.notify_all()
+                encoders = list(self.encoders.items())
+
+            for encoder, (output, name) in encoders:
+                stream = buffers[name]
+                if name == 'lores':
+                    stream = cv2.cvtColor(stream, cv2.COLOR_YUV2RGB_I420)
+                data, keyframe = encoder.encode(stream, index, self.fps)
+                output.outputframe(data, keyframe, timestamp // 1000)
+            index += 1
+
+class SimulatedPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    @staticmethod
+    def check(duty_cycle):
+        # RPi.GPIO rejects these the same way
+        if not 0.0 <= duty_cycle <= 100.0:
+            raise ValueError("dutycycle must have a value from 0.0 to 100.0")
+
+    def start(self, duty_cycle):
+        self.check(duty_cycle)
+        self.gpio.record('start', self.pin, duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.check(duty_cycle)
+        self.gpio.record('ChangeDutyCycle', self.pin, duty_cycle)
+
+    def stop(self):
+        self.gpio.record('stop', self.pin, None)
+
+class SimulatedGPIO:
+    """RPi.GPIO stand-in logging every pin write with a monotonic timestamp"""
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, log_size=GPIO_LOG_SIZE):
+        self.calls = collections.deque(maxlen=log_size)  # (time, call, pin, value)
+        self.counts = collections.Counter()
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def record(self, call, pin, value):
+        with self.lock:
+            self.calls.append((time.monotonic(), call, pin, value))
+            self.counts[call] += 1
+            if call == 'output':
+                self.levels[pin] = value
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, mode, initial=LOW):
+        self.record('setup', pin, initial)
+
+    def output(self, pin, value):
+        self.record('output', pin, value)
+
+    def PWM(self, pin, frequency):
+        return SimulatedPWM(self, pin, frequency)
+
+    def cleanup(self):
+        self.record('cleanup', None, None)
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.counts), 'levels': dict(self.levels)}